@@ -0,0 +1,133 @@
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import ugettext_lazy as _
+
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+
+from utils.cache import ConfiguredCache
+
+from .tokens import is_signed_token, read_signed_token, signed_tokens_enabled
+
+# Never cached, so shared caches hold no password hashes.
+# Restored instances load them from the row if ever read.
+EXCLUDED_FIELDS = ('password',)
+
+def snapshot_fields(model):
+    return [
+        field.attname for field in model._meta.concrete_fields
+        if field.attname not in EXCLUDED_FIELDS
+    ]
+
+def snapshot(instance):
+    '''
+    Plain tuple of the instance's concrete field values,
+    but the password, cheap to store and safe to pickle
+    into a shared cache
+    '''
+    return tuple(getattr(instance, name) for name in snapshot_fields(type(instance)))
+
+def restore(model, values):
+    '''
+    Builds a fresh instance from a snapshot, so
+    concurrent requests never share a cached object.
+    The password is left deferred.
+    '''
+    return model.from_db(DEFAULT_DB_ALIAS, snapshot_fields(model), values)
+
+class TokenCache(ConfiguredCache):
+    '''
+    Maps token keys to (user, token) snapshots.
+    Since a user owns a single token, the key is also
+    indexed by user pk so it can be evicted when the user changes.
+    '''
+    def __init__(self):
+        super(TokenCache, self).__init__('TOKEN_AUTH_CACHE', 'token-auth')
+
+    def get_credentials(self, key, token_model):
+        entry = self.get(key)
+        if entry is None:
+            return None
+        user_values, token_values = entry
+        user = restore(get_user_model(), user_values)
+        token = restore(token_model, token_values)
+        token.user = user
+        return user, token
+
+    def set_credentials(self, user, token):
+        self.set(token.key, (snapshot(user), snapshot(token)))
+        self.set('user:{}'.format(user.pk), token.key)
+
+    def evict_token(self, key):
+        self.delete(key)
+
+    def evict_user(self, pk):
+        user_key = 'user:{}'.format(pk)
+        key = self.get(user_key)
+        if key is not None:
+            self.delete(key)
+        self.delete(user_key)
+
+token_cache = TokenCache()
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''
+    TokenAuthentication that remembers which user owns
+    each token, so repeat requests skip the Token + User query.
+    Entries are evicted by the signals in accounts.models
+    whenever a token is issued, deleted or its user is saved.
+    '''
+    def authenticate_credentials(self, key):
+        credentials = token_cache.get_credentials(key, self.get_model())
+        if credentials is None:
+            credentials = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+            token_cache.set_credentials(*credentials)
+        return credentials
+
+'''
+Users authenticated by SignedTokenAuthentication, as
+snapshots keyed by pk, evicted by the signals in accounts.models
+'''
+signed_token_users = ConfiguredCache('SIGNED_TOKENS', 'signed-token-user')
+
+class SignedTokenAuthentication(TokenAuthentication):
+    '''
+    Authenticates the tokens from accounts.tokens, which
+    share the Token keyword with authtoken ones. Other tokens
+    are left to the next class, so it goes first.
+    Only the token's user is read, from signed_token_users
+    when it was seen recently.
+    '''
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not signed_tokens_enabled() or len(auth) != 2 or not is_signed_token(auth[1].decode('latin-1')):
+            return None
+        return super(SignedTokenAuthentication, self).authenticate(request)
+
+    def authenticate_credentials(self, key):
+        try:
+            user_pk, generation = read_signed_token(key)
+        except signing.SignatureExpired:
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+        except signing.BadSignature:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        user = self.get_user(user_pk)
+        if user is None or not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        if user.credential_generation != generation:
+            # Revoked by a password change
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        return user, key
+
+    def get_user(self, pk):
+        model = get_user_model()
+        values = signed_token_users.get(str(pk))
+        if values is not None:
+            return restore(model, values)
+        try:
+            user = model._default_manager.get(pk=pk)
+        except (model.DoesNotExist, ValueError):
+            return None
+        signed_token_users.set(str(pk), snapshot(user))
+        return user
@@ -0,0 +1,373 @@
+'''
+Scenarios for the benchmark management command.
+Each takes the command options and returns a flat
+dict of results, timings are in seconds.
+'''
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.wsgi import get_wsgi_application
+from django.db import OperationalError, connection
+from django.db.backends.sqlite3.base import DatabaseWrapper as DefaultSQLiteWrapper
+from django.test.utils import override_settings
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from utils.asgi import WSGIToASGI, build_environ
+from utils.benchmark import stopwatch
+from utils.db.sqlite3.base import DatabaseWrapper as TunedSQLiteWrapper
+from utils.serializers import ValuesSerializer
+
+from .password_index import build_index, open_index, password_digest
+from .serializers import UserSerializer
+from .throttles import bucket_store
+
+User = get_user_model()
+
+def admin_client():
+    admin = User.objects.create_superuser('bench_admin', 'bench@admin.com', 'bench-admin-pass')
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token {}'.format(Token.objects.get(user=admin).key))
+    return client
+
+def user_rows(prefix, count):
+    return [
+        {'username': '{}_{}'.format(prefix, i), 'email': '{}_{}@bench.com'.format(prefix, i), 'password': 'bench-pass-{}-x9!'.format(i)}
+        for i in range(count)
+    ]
+
+def bulk_create(options):
+    '''
+    One POST /users/ per user against a single POST /users/bulk/
+    '''
+    count = options['count'] or 200
+    client = admin_client()
+    results = {'users': count}
+
+    with stopwatch(results, 'one_by_one_seconds'):
+        for row in user_rows('single', count):
+            response = client.post('/users/', json.dumps(row), content_type='application/json')
+            assert response.status_code == 201, response.content
+
+    with stopwatch(results, 'bulk_seconds'):
+        response = client.post('/users/bulk/', json.dumps(user_rows('bulk', count)), content_type='application/json')
+        assert response.status_code == 201, response.content
+
+    results['one_by_one_users_per_second'] = count / results['one_by_one_seconds']
+    results['bulk_users_per_second'] = count / results['bulk_seconds']
+    results['speedup'] = results['one_by_one_seconds'] / results['bulk_seconds']
+    return results
+
+def password_index(options):
+    '''
+    Lookups in the memory-mapped breached passwords
+    index against a Python set of the same digests
+    '''
+    count = options['count'] or 1000000
+    lookups = 100000
+    corpus = ['breached-{}'.format(i).encode() for i in range(count)]
+    probes = [password_digest(random.choice(corpus)) for _ in range(lookups // 2)]
+    probes += [password_digest('unseen-{}'.format(i)) for i in range(lookups // 2)]
+    random.shuffle(probes)
+    results = {'passwords': count, 'lookups': lookups}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'passwords.idx')
+        with stopwatch(results, 'build_seconds'):
+            build_index(iter(corpus), path)
+        results['index_bytes'] = os.path.getsize(path)
+        index = open_index(path)
+        start = time.perf_counter()
+        hits = sum(1 for probe in probes if probe in index)
+        results['mmap_lookup_microseconds'] = (time.perf_counter() - start) / lookups * 1e6
+        assert hits >= lookups // 2
+
+    tracemalloc.start()
+    digests = set(password_digest(password) for password in corpus)
+    results['set_bytes'] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    sum(1 for probe in probes if probe in digests)
+    results['set_lookup_microseconds'] = (time.perf_counter() - start) / lookups * 1e6
+    return results
+
+def retrieve_cache(options):
+    '''
+    GET /users/{pk}/ with and without the representation cache
+    '''
+    count = options['count'] or 5000
+    user = User.objects.create_user('bench_user', 'bench@user.com', 'bench-user-pass')
+    client = APIClient()
+    client.force_authenticate(user=user)
+    url = '/users/{}/'.format(user.pk)
+    results = {'requests': count}
+
+    disabled = {'MAX_SIZE': 0, 'TTL': 0, 'CACHE_ALIAS': None}
+    for name, cache_settings in (('uncached', disabled), ('cached', settings.USER_REPRESENTATION_CACHE)):
+        with override_settings(USER_REPRESENTATION_CACHE=cache_settings):
+            client.get(url)
+            with stopwatch(results, name + '_seconds'):
+                for _ in range(count):
+                    client.get(url)
+        results[name + '_requests_per_second'] = count / results[name + '_seconds']
+    results['speedup'] = results['uncached_seconds'] / results['cached_seconds']
+    return results
+
+def request_overhead(options):
+    '''
+    Token-authenticated GET /users/{pk}/ under the
+    current settings, with the representation cache off
+    '''
+    count = options['count'] or 2000
+    user = User.objects.create_user('bench_user', 'bench@user.com', 'bench-user-pass')
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token {}'.format(Token.objects.create(user=user).key))
+    url = '/users/{}/'.format(user.pk)
+    results = {'requests': count}
+    with override_settings(USER_REPRESENTATION_CACHE={'MAX_SIZE': 0, 'TTL': 0}):
+        response = client.get(url)
+        assert response.status_code == 200, response.content
+        with stopwatch(results, 'seconds'):
+            for _ in range(count):
+                client.get(url)
+    results['microseconds_per_request'] = results['seconds'] / count * 1e6
+    return results
+
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+import django
+django.setup()
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+print(time.perf_counter() - start)
+'''
+
+def settings_profiles(options):
+    '''
+    Startup time and per request overhead of the default
+    settings against the API-only ones, each in its own process
+    '''
+    count = options['count'] or 2000
+    manage = os.path.join(settings.BASE_DIR, 'manage.py')
+    results = {}
+    for name, module in (('default', 'api.settings'), ('api', 'api.settings_api')):
+        environment = dict(os.environ, DJANGO_SETTINGS_MODULE=module)
+        startups = sorted(
+            float(subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], env=environment, cwd=settings.BASE_DIR))
+            for _ in range(5)
+        )
+        results[name + '_startup_seconds'] = startups[len(startups) // 2]
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            subprocess.check_call(
+                [sys.executable, manage, 'benchmark', 'request_overhead', '--count', str(count), '--output', output.name],
+                env=environment, stdout=subprocess.DEVNULL,
+            )
+            overhead = json.load(output)
+        results[name + '_microseconds_per_request'] = overhead['microseconds_per_request']
+    return results
+
+def fast_serializer(options):
+    '''
+    UserSerializer over model instances against
+    ValuesSerializer over values() rows
+    '''
+    count = options['count'] or 10000
+    User.objects.bulk_create(
+        User(username='bench_{}'.format(i), email='bench_{}@bench.com'.format(i)) for i in range(count)
+    )
+    queryset = User.objects.order_by('id')
+    results = {'users': count}
+
+    with stopwatch(results, 'serializer_seconds'):
+        UserSerializer(queryset, many=True).data
+    with stopwatch(results, 'values_serializer_seconds'):
+        compiled = ValuesSerializer.compile(UserSerializer())
+        [compiled.to_representation(row) for row in queryset.values(*compiled.columns)]
+    results['speedup'] = results['serializer_seconds'] / results['values_serializer_seconds']
+    return results
+
+def asgi_concurrency(options):
+    '''
+    Token-authenticated GET /users/{pk}/ from clients taking
+    20ms to send their request and 20ms to read the response,
+    with 4 threads, 64 requests in flight.
+    WSGI holds a thread for the whole exchange, the
+    ASGI adapter only while the view runs.
+    '''
+    count = options['count'] or 256
+    threads, concurrency, latency = 4, 64, .02
+    user = User.objects.create_user('bench_user', 'bench@user.com', 'bench-user-pass')
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': '/users/{}/'.format(user.pk), 'query_string': b'',
+        'headers': [
+            (b'host', b'testserver'),
+            (b'authorization', 'Token {}'.format(Token.objects.create(user=user).key).encode()),
+        ],
+    }
+    wsgi_application = get_wsgi_application()
+    results = {'requests': count, 'threads': threads, 'concurrency': concurrency, 'client_latency_seconds': latency}
+
+    def wsgi_exchange(_):
+        time.sleep(latency)
+        statuses = []
+        chunks = wsgi_application(build_environ(scope, BytesIO()), lambda status, headers: statuses.append(status))
+        content = b''.join(chunks)
+        chunks.close()
+        time.sleep(latency)
+        assert statuses[0].startswith('200'), content
+
+    with stopwatch(results, 'wsgi_seconds'):
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(wsgi_exchange, range(count)))
+
+    asgi_application = WSGIToASGI(wsgi_application, threads=threads)
+
+    async def asgi_exchange(slots):
+        async def receive():
+            await asyncio.sleep(latency)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                assert message['status'] == 200, message
+            elif not message['more_body']:
+                await asyncio.sleep(latency)
+
+        async with slots:
+            await asgi_application(scope, receive, send)
+
+    async def asgi_run():
+        slots = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(asgi_exchange(slots) for _ in range(count)))
+
+    loop = asyncio.new_event_loop()
+    with stopwatch(results, 'asgi_seconds'):
+        loop.run_until_complete(asgi_run())
+    loop.close()
+    asgi_application.executor.shutdown()
+
+    results['wsgi_requests_per_second'] = count / results['wsgi_seconds']
+    results['asgi_requests_per_second'] = count / results['asgi_seconds']
+    return results
+
+def sqlite_tuning(options):
+    '''
+    8 threads running signups (a transaction inserting a user
+    and its token) and retrieves (a user and its token by pk),
+    one in five being a signup, against an on-disk database.
+    Plain sqlite3 opening a connection per request, as with
+    CONN_MAX_AGE 0, against utils.db.sqlite3 configured as
+    in settings.DATABASES with persistent connections.
+    '''
+    count = options['count'] or 4000
+    threads = 8
+    results = {'requests': count, 'threads': threads}
+
+    def run(name, wrapper_class, db_options, persistent):
+        directory = tempfile.TemporaryDirectory()
+        settings_dict = dict(
+            connection.settings_dict, NAME=os.path.join(directory.name, 'bench.sqlite3'),
+            CONN_MAX_AGE=60 if persistent else 0, OPTIONS=db_options,
+        )
+        setup = wrapper_class(settings_dict, alias=name)
+        with setup.cursor() as cursor:
+            cursor.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT)')
+            cursor.execute('CREATE TABLE tokens (key TEXT PRIMARY KEY, user_id INTEGER UNIQUE)')
+            cursor.executemany('INSERT INTO users (username, password) VALUES (%s, %s)', [
+                ('seed_{}'.format(i), 'x' * 80) for i in range(1000)
+            ])
+            cursor.executemany('INSERT INTO tokens VALUES (%s, %s)', [
+                ('seed-token-{}'.format(i), i + 1) for i in range(1000)
+            ])
+        setup.close()
+        errors = []
+
+        def worker(index):
+            wrapper = wrapper_class(settings_dict, alias=name)
+            for i in range(index, count, threads):
+                try:
+                    with wrapper.cursor() as cursor:
+                        if i % 5 == 0:
+                            cursor.execute('BEGIN')
+                            cursor.execute('INSERT INTO users (username, password) VALUES (%s, %s)', ['user_{}'.format(i), 'x' * 80])
+                            cursor.execute('INSERT INTO tokens VALUES (%s, %s)', ['token-{}'.format(i), cursor.lastrowid])
+                            cursor.execute('COMMIT')
+                        else:
+                            cursor.execute('SELECT * FROM users WHERE id = %s', [random.randint(1, 1000)])
+                            cursor.fetchone()
+                            cursor.execute('SELECT key FROM tokens WHERE user_id = %s', [random.randint(1, 1000)])
+                            cursor.fetchone()
+                except OperationalError:
+                    errors.append(i)
+                    if wrapper.connection is not None and wrapper.connection.in_transaction:
+                        wrapper.connection.rollback()
+                if not persistent:
+                    wrapper.close()
+            wrapper.close()
+
+        with stopwatch(results, name + '_seconds'):
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(worker, range(threads)))
+        results[name + '_requests_per_second'] = count / results[name + '_seconds']
+        results[name + '_errors'] = len(errors)
+        directory.cleanup()
+
+    run('default', DefaultSQLiteWrapper, {}, persistent=False)
+    run('tuned', TunedSQLiteWrapper, settings.DATABASES['default']['OPTIONS'], persistent=True)
+    return results
+
+def throttled_logins(options):
+    '''
+    Failed POST /get_auth_token/ for one username, checked
+    against its password hash, against the same attempts
+    once its token bucket is empty
+    '''
+    count = options['count'] or 200
+    User.objects.create_user('bench_user', 'bench@user.com', 'bench-user-pass')
+    client = APIClient()
+    body = json.dumps({'username': 'bench_user', 'password': 'wrong'})
+    results = {'requests': count}
+
+    def attempts(expected_status):
+        for i in range(count):
+            # Spread over addresses so only the username bucket applies
+            address = '10.0.{}.{}'.format(i // 250, i % 250)
+            response = client.post('/get_auth_token/', body, content_type='application/json', REMOTE_ADDR=address)
+            assert response.status_code == expected_status, response.content
+
+    # Refilling slowly enough for the bucket to stay empty
+    rates = {'credentials_ip': '1000/min', 'credentials_username': '{}/day'.format(count)}
+    with override_settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates)):
+        bucket_store.clear()
+        with stopwatch(results, 'checked_seconds'):
+            attempts(400)
+        with stopwatch(results, 'throttled_seconds'):
+            attempts(429)
+    results['checked_microseconds_per_request'] = results['checked_seconds'] / count * 1e6
+    results['throttled_microseconds_per_request'] = results['throttled_seconds'] / count * 1e6
+    return results
+
+SCENARIOS = {
+    'bulk_create': bulk_create,
+    'password_index': password_index,
+    'retrieve_cache': retrieve_cache,
+    'request_overhead': request_overhead,
+    'settings_profiles': settings_profiles,
+    'fast_serializer': fast_serializer,
+    'asgi_concurrency': asgi_concurrency,
+    'sqlite_tuning': sqlite_tuning,
+    'throttled_logins': throttled_logins,
+}
@@ -0,0 +1,113 @@
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+
+from rest_framework.authtoken.models import Token
+
+from .hashing import hash_passwords
+from .serializers import BulkUserSerializer
+from .tokens import legacy_tokens_enabled
+
+User = get_user_model()
+
+def provision_users(rows, chunk_size=500):
+    '''
+    Validates, hashes and inserts many users at once.
+    Returns (created, errors), both lists of dicts carrying
+    the row's index in the payload.
+    Every chunk of users is inserted along with
+    their tokens in its own transaction.
+    '''
+    errors = []
+    valid = []
+    for index, row in enumerate(rows):
+        serializer = BulkUserSerializer(data=row)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            errors.append({'index': index, 'errors': serializer.errors})
+
+    '''
+    Usernames are checked against the payload and
+    the table once per chunk, not once per user
+    '''
+    unique_message = User._meta.get_field('username').error_messages['unique']
+    seen = set()
+    for start in range(0, len(valid), chunk_size):
+        usernames = [data['username'] for _, data in valid[start:start + chunk_size]]
+        seen.update(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    accepted = []
+    for index, data in valid:
+        if data['username'] in seen:
+            errors.append({'index': index, 'errors': {'username': [unique_message]}})
+        else:
+            seen.add(data['username'])
+            accepted.append((index, data))
+
+    passwords = hash_passwords(data.pop('password') for _, data in accepted)
+
+    created = []
+    for start in range(0, len(accepted), chunk_size):
+        chunk = [
+            (index, User(password=password, **data))
+            for (index, data), password in zip(accepted[start:start + chunk_size], passwords[start:start + chunk_size])
+        ]
+        while chunk:
+            try:
+                with transaction.atomic():
+                    tokens = _insert([user for _, user in chunk])
+                break
+            except IntegrityError:
+                chunk = _drop_taken(chunk, errors, unique_message)
+        created.extend(
+            dict(
+                {'index': index, 'id': user.pk, 'username': user.username, 'email': user.email},
+                **user.get_auth_tokens(tokens.get(user.pk))
+            )
+            for index, user in chunk
+        )
+
+    errors.sort(key=lambda error: error['index'])
+    return created, errors
+
+def _drop_taken(chunk, errors, unique_message):
+    '''
+    Reports the rows of a chunk whose username was taken by a
+    concurrent request since it was checked, and returns the
+    others to be inserted again. If none was taken, the insert
+    failed for another reason and the whole chunk is reported.
+    '''
+    taken = set(
+        User.objects.filter(username__in=[user.username for _, user in chunk])
+        .values_list('username', flat=True)
+    )
+    if not taken:
+        errors.extend(
+            {'index': index, 'errors': {'non_field_errors': ['User could not be created, try again.']}}
+            for index, _ in chunk
+        )
+        return []
+    errors.extend(
+        {'index': index, 'errors': {'username': [unique_message]}}
+        for index, user in chunk if user.username in taken
+    )
+    return [(index, user) for index, user in chunk if user.username not in taken]
+
+def _insert(users):
+    User.objects.bulk_create(users)
+    if users and users[0].pk is None:
+        # Only some backends return the primary keys of bulk inserts
+        ids = dict(
+            User.objects.filter(username__in=[user.username for user in users])
+            .values_list('username', 'id')
+        )
+        for user in users:
+            user.pk = ids[user.username]
+    if not legacy_tokens_enabled():
+        return {}
+    tokens = {}
+    for user in users:
+        token = Token(user_id=user.pk)
+        token.key = token.generate_key()
+        tokens[user.pk] = token
+    Token.objects.bulk_create(tokens.values())
+    return tokens
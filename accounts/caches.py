@@ -0,0 +1,7 @@
+from utils.cache import ConfiguredCache
+
+'''
+Rendered JSON of retrieved users, by pk, version and fieldset.
+Entries of older versions age out, see CachedRepresentationMixin
+'''
+representation_cache = ConfiguredCache('USER_REPRESENTATION_CACHE', 'user-representation')
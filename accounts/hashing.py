@@ -0,0 +1,197 @@
+'''
+Password hashing off the request threads.
+
+User.set_password and User.check_password go through the
+executor configured by PASSWORD_HASHING['EXECUTOR'], by default
+a process pool, so a burst of logins or signups can't pin
+every worker thread. Once MAX_QUEUE operations are in flight,
+new ones raise HashingUnavailable, which the views answer
+with a 503 and a Retry-After header.
+'''
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import (
+    get_hasher, identify_hasher, is_password_usable, make_password,
+)
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from utils.metrics import Counter, Gauge, Histogram
+
+queue_depth = Gauge('password_hash_queue_depth', 'Password operations waiting for or running in the pool.')
+hash_seconds = Histogram('password_hash_seconds', 'Time to hash or verify a password, queueing included.')
+rejected = Counter('password_hash_rejected_total', 'Password operations rejected because the queue was full.')
+
+class HashingUnavailable(Exception):
+    '''
+    Raised when the hashing queue is full, wait
+    being the seconds after which to try again
+    '''
+    def __init__(self, wait):
+        super(HashingUnavailable, self).__init__('Too many password operations in progress, try again later.')
+        self.wait = wait
+
+def verify_password(password, encoded):
+    '''
+    django.contrib.auth.hashers.check_password without the
+    setter, which has to run in the calling process.
+    Returns (is_correct, must_update).
+    '''
+    if password is None or not is_password_usable(encoded):
+        return False, False
+    preferred = get_hasher('default')
+    try:
+        hasher = identify_hasher(encoded)
+    except ValueError:
+        return False, False
+    hasher_changed = hasher.algorithm != preferred.algorithm
+    must_update = hasher_changed or preferred.must_update(encoded)
+    is_correct = hasher.verify(password, encoded)
+    if not is_correct and not hasher_changed and must_update:
+        preferred.harden_runtime(password, encoded)
+    return is_correct, must_update
+
+def make_passwords(passwords):
+    return [make_password(password) for password in passwords]
+
+def _setup_worker():
+    '''
+    Runs once in every pool worker, which starts from
+    a fresh interpreter and has to set Django up
+    '''
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+    django.setup()
+
+class InlineHashingExecutor(object):
+    '''
+    Hashes on the calling thread
+    '''
+    def __init__(self, options):
+        self.options = options
+
+    def run(self, function, *args):
+        return function(*args)
+
+    def make_password(self, password):
+        if password is None:
+            # Unusable passwords need no hashing
+            return make_password(None)
+        start = time.perf_counter()
+        try:
+            return self.run(make_password, password)
+        finally:
+            hash_seconds.observe(time.perf_counter() - start, operation='make')
+
+    def check_password(self, password, encoded, setter=None):
+        start = time.perf_counter()
+        try:
+            is_correct, must_update = self.run(verify_password, password, encoded)
+        finally:
+            hash_seconds.observe(time.perf_counter() - start, operation='check')
+        if setter and is_correct and must_update:
+            setter(password)
+        return is_correct
+
+    def map_make_password(self, passwords):
+        return make_passwords(passwords)
+
+    def shutdown(self):
+        pass
+
+class ProcessPoolHashingExecutor(InlineHashingExecutor):
+    '''
+    Hashes on a pool of WORKERS processes, with at
+    most MAX_QUEUE operations queued or running
+    '''
+    def __init__(self, options):
+        super(ProcessPoolHashingExecutor, self).__init__(options)
+        self.workers = options['WORKERS']
+        # The pool starts in threaded servers, where forking could copy
+        # locks held by other threads into the workers and deadlock them
+        context = multiprocessing.get_context(options.get('START_METHOD', 'forkserver'))
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_setup_worker)
+        self.slots = threading.BoundedSemaphore(options['MAX_QUEUE'])
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            rejected.inc()
+            raise HashingUnavailable(self.options['RETRY_AFTER'])
+        queue_depth.inc()
+        try:
+            return self.pool.submit(function, *args).result()
+        finally:
+            queue_depth.dec()
+            self.slots.release()
+
+    def map_make_password(self, passwords):
+        '''
+        Bulk hashing is split into chunks of BULK_CHUNK_SIZE
+        passwords, each taking a slot of the queue like any other
+        operation, with at most WORKERS chunks in flight. Other
+        operations wait behind a chunk per worker at most.
+        A chunk waits up to RETRY_AFTER seconds for its slot.
+        '''
+        if self.workers <= 1 or len(passwords) < self.options['MIN_BATCH']:
+            return super(ProcessPoolHashingExecutor, self).map_make_password(passwords)
+        size = self.options.get('BULK_CHUNK_SIZE', 8)
+        in_flight = deque()
+        hashed = []
+        for start in range(0, len(passwords), size):
+            if len(in_flight) >= self.workers:
+                hashed.extend(in_flight.popleft().result())
+            in_flight.append(self.submit_chunk(passwords[start:start + size]))
+        for future in in_flight:
+            hashed.extend(future.result())
+        return hashed
+
+    def submit_chunk(self, passwords):
+        if not self.slots.acquire(timeout=self.options['RETRY_AFTER']):
+            rejected.inc()
+            raise HashingUnavailable(self.options['RETRY_AFTER'])
+        queue_depth.inc()
+        try:
+            future = self.pool.submit(make_passwords, passwords)
+        except Exception:
+            self.release_slot()
+            raise
+        future.add_done_callback(lambda future: self.release_slot())
+        return future
+
+    def release_slot(self):
+        queue_depth.dec()
+        self.slots.release()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            options = settings.PASSWORD_HASHING
+            _executor = import_string(options['EXECUTOR'])(options)
+        return _executor
+
+@receiver(setting_changed)
+def reset_executor(setting, **kwargs):
+    global _executor
+    if setting == 'PASSWORD_HASHING' and _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+def hash_passwords(passwords):
+    '''
+    Hashes many passwords at once, keeping their order
+    '''
+    return get_executor().map_make_password(list(passwords))
@@ -0,0 +1,24 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from utils.benchmark import test_database
+
+from ...benchmarks import SCENARIOS
+
+class Command(BaseCommand):
+    help = 'Runs a benchmark scenario against a throwaway test database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--count', type=int, help='Size of the workload, defaults per scenario.')
+        parser.add_argument('--output', help='Also write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        with test_database():
+            results = SCENARIOS[options['scenario']](options)
+        for name, value in results.items():
+            self.stdout.write('{:<40} {}'.format(name, round(value, 4) if isinstance(value, float) else value))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...password_index import build_index, password_digest, sha1_hex_digest
+
+class Command(BaseCommand):
+    help = 'Builds the breached passwords index used by BreachedPasswordValidator from a list, one entry per line.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Plain text passwords, or hex SHA-1 hashes with --sha1.')
+        parser.add_argument('--output', default=None, help='Defaults to the BREACHED_PASSWORDS_INDEX setting.')
+        parser.add_argument('--sha1', action='store_true', help='Lines are hex SHA-1 hashes, optionally followed by :count.')
+        parser.add_argument('--chunk-size', type=int, default=1000000, help='Lines sorted in memory at once.')
+
+    def handle(self, *args, **options):
+        output = options['output'] or settings.BREACHED_PASSWORDS_INDEX
+        digest = sha1_hex_digest if options['sha1'] else password_digest
+        with open(options['source'], 'rb') as source:
+            count = build_index(source, output, digest, options['chunk_size'])
+        self.stdout.write('Wrote {} passwords to {}'.format(count, output))
@@ -0,0 +1,84 @@
+import os
+import pstats
+from collections import Counter, defaultdict
+from io import StringIO
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.profiling import get_options, parse_name
+
+class Command(BaseCommand):
+    help = 'Sums up the request profiles of ProfilingMiddleware into the hotspots of each view and action.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help='Defaults to REQUEST_PROFILING[\'DIRECTORY\'].')
+        parser.add_argument('--view', help='Only report views starting with this, e.g. UserViewSet.change_password.')
+        parser.add_argument('--limit', type=int, default=15, help='Functions listed per view.')
+        parser.add_argument(
+            '--sort', choices=['tottime', 'cumtime'], default='tottime',
+            help='Time spent in the function itself, or including its callees.'
+        )
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or get_options().get('DIRECTORY')
+        if not directory or not os.path.isdir(directory):
+            raise CommandError('No profiles directory {}.'.format(directory))
+
+        profiles = defaultdict(list)
+        for name in sorted(os.listdir(directory)):
+            parsed = parse_name(name)
+            if parsed is not None and parsed[0].startswith(options['view'] or ''):
+                profiles[parsed].append(os.path.join(directory, name))
+        if not profiles:
+            self.stdout.write('No profiles found in {}.'.format(directory))
+            return
+
+        for (view, profile_format), paths in sorted(profiles.items()):
+            self.stdout.write('{} ({} {} profiles)'.format(view, len(paths), profile_format))
+            if profile_format == 'prof':
+                self.report_stats(paths, options['sort'], options['limit'])
+            else:
+                self.report_stacks(paths, options['sort'], options['limit'])
+            self.stdout.write('')
+
+    def report_stats(self, paths, sort, limit):
+        '''
+        Seconds per request, averaged over the profiles
+        '''
+        stats = pstats.Stats(*paths, stream=StringIO())
+        column = 2 if sort == 'tottime' else 3
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][column], reverse=True)[:limit]
+        self.stdout.write('  {:>10} {:>10} {:>10}  {}'.format('tottime', 'cumtime', 'calls', 'function'))
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in rows:
+            self.stdout.write('  {:>10.6f} {:>10.6f} {:>10.1f}  {}:{}({})'.format(
+                tottime / len(paths), cumtime / len(paths), calls / len(paths),
+                os.path.basename(filename), line, function
+            ))
+
+    def report_stacks(self, paths, sort, limit):
+        '''
+        Share of the samples where the function
+        was running, or anywhere on the stack
+        '''
+        own = Counter()
+        anywhere = Counter()
+        total = 0
+        for path in paths:
+            with open(path) as profile:
+                for line in profile:
+                    stack, count = line.rsplit(' ', 1)
+                    frames = stack.split(';')
+                    count = int(count)
+                    total += count
+                    own[frames[-1]] += count
+                    for frame in set(frames):
+                        anywhere[frame] += count
+        if not total:
+            self.stdout.write('  No samples, the requests took less than SAMPLE_INTERVAL.')
+            return
+        ranking = own if sort == 'tottime' else anywhere
+        self.stdout.write('  {:>8} {:>8}  {}'.format('self', 'total', 'function'))
+        for frame, _ in ranking.most_common(limit):
+            self.stdout.write('  {:>7.1%} {:>7.1%}  {}'.format(
+                own[frame] / total, anywhere[frame] / total, frame
+            ))
@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.benchmark import test_database, test_environment
+from utils.replay import Replayer, compare, load_log
+
+class Command(BaseCommand):
+    help = (
+        'Replays a JSONL request log in-process and reports latency percentiles, '
+        'throughput and SQL queries per route. See utils.replay for the log format.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('log')
+        parser.add_argument('--concurrency', type=int, default=1)
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--baseline', help='Results of a previous run to compare against.')
+        parser.add_argument(
+            '--max-regression', type=float, default=0.2,
+            help='Allowed p95 growth over the baseline, as a fraction. Defaults to 0.2.'
+        )
+        parser.add_argument(
+            '--live-database', action='store_true',
+            help=(
+                'Replay against the configured database instead of a throwaway test one. '
+                'Recorded writes are applied to it.'
+            )
+        )
+
+    def handle(self, *args, **options):
+        entries = load_log(options['log'])
+        environment = test_environment() if options['live_database'] else test_database()
+        with environment:
+            results = Replayer(entries, options['concurrency']).run()
+
+        self.stdout.write('{requests} requests in {seconds:.2f}s, {requests_per_second:.1f} req/s'.format(**results))
+        for route, stats in results['routes'].items():
+            self.stdout.write(
+                '{:<28} n={requests:<6} p50={p50_ms:.2f}ms p95={p95_ms:.2f}ms '
+                'p99={p99_ms:.2f}ms queries={queries_per_request:.2f}'.format(route, **stats)
+            )
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = compare(results, json.load(baseline), options['max_regression'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
@@ -0,0 +1,22 @@
+from django.http import HttpResponse
+
+from .hashing import HashingUnavailable
+
+class HashingUnavailableMiddleware(object):
+    '''
+    Answers HashingUnavailable raised by views outside of
+    rest_framework, such as the admin's login, with a 503.
+    rest_framework views handle it themselves (see accounts.views).
+    '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, HashingUnavailable):
+            return None
+        response = HttpResponse(str(exception), status=503, content_type='text/plain')
+        response['Retry-After'] = str(exception.wait)
+        return response
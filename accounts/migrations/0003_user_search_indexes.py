@@ -0,0 +1,28 @@
+# Generated by Django 2.0 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_user_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['email'], name='accounts_user_email_idx'),
+        ),
+        # Expression indexes for the case insensitive lookups of IndexedFilterBackend
+        migrations.RunSQL(
+            [
+                'CREATE INDEX accounts_user_username_lower ON accounts_user (LOWER(username))',
+                'CREATE INDEX accounts_user_email_lower ON accounts_user (LOWER(email))',
+            ],
+            [
+                'DROP INDEX IF EXISTS accounts_user_username_lower',
+                'DROP INDEX IF EXISTS accounts_user_email_lower',
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.0 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_user_search_indexes'),
+    ]
+
+    # SQLite adds and removes fields by rebuilding the table, which drops
+    # the expression indexes from 0003 as Django doesn't know them
+    recreate_lower_indexes = [
+        'CREATE INDEX IF NOT EXISTS accounts_user_username_lower ON accounts_user (LOWER(username))',
+        'CREATE INDEX IF NOT EXISTS accounts_user_email_lower ON accounts_user (LOWER(email))',
+    ]
+
+    operations = [
+        # Reversed last, once the field is removed
+        migrations.RunSQL(migrations.RunSQL.noop, recreate_lower_indexes),
+        migrations.AddField(
+            model_name='user',
+            name='credential_generation',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunSQL(recreate_lower_indexes, migrations.RunSQL.noop),
+    ]
@@ -1,12 +1,91 @@
 from django.contrib.auth.models import AbstractUser
-from django.db.models.signals import post_save
+from django.db import models, router, transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 from rest_framework.authtoken.models import Token
 
+from utils.models import claim_version
+
+from .authentication import signed_token_users, token_cache
+from .hashing import get_executor
+from .tokens import legacy_tokens_enabled, make_signed_token, signed_tokens_enabled
+
 class User(AbstractUser):
+    '''
+    Password hashing and checks run on the
+    executor from accounts.hashing
+    '''
+    # Bumped by every save, identifies the user's representation in ETags
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Signed tokens from older generations are revoked, see accounts.tokens
+    credential_generation = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta(AbstractUser.Meta):
+        # LOWER(username) and LOWER(email) are indexed by a RunSQL in 0003.
+        # SQLite drops them when a migration rebuilds the table, so
+        # migrations altering it have to create them again (see 0004)
+        indexes = [models.Index(fields=['email'], name='accounts_user_email_idx')]
+
+    def save(self, *args, **kwargs):
+        '''
+        Existing rows are only saved over the version they were
+        read at, raising utils.models.VersionConflict otherwise,
+        so every version is a single state of the row.
+        Also when only some fields are saved.
+        '''
+        if self._state.adding:
+            super(User, self).save(*args, **kwargs)
+            return
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            claim_version(self, using=using)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'version'}
+            super(User, self).save(*args, **kwargs)
+
+    def set_password(self, raw_password):
+        self.password = get_executor().make_password(raw_password)
+        self._password = raw_password
+
+    def check_password(self, raw_password):
+        def setter(raw_password):
+            self.set_password(raw_password)
+            # Password hash upgrades shouldn't be considered password changes
+            self._password = None
+            self.save(update_fields=['password'])
+        return get_executor().check_password(raw_password, self.password, setter)
+
     def set_auth_token(self):
-        return {'token': Token.objects.create(user=self).key}
+        token = Token.objects.create(user=self) if legacy_tokens_enabled() else None
+        return self.get_auth_tokens(token)
+
+    def get_auth_tokens(self, token=None):
+        '''
+        The user's tokens in each enabled format,
+        token being its authtoken one while they're issued
+        '''
+        tokens = {}
+        if token is not None:
+            tokens['token'] = token.key
+        if signed_tokens_enabled():
+            tokens['signed_token'] = make_signed_token(self)
+        return tokens
+
+    def revoke_auth_tokens(self):
+        '''
+        Revokes the signed tokens, bumping credential_generation
+        in the row so concurrent revocations all count, and
+        deletes the authtoken one if still in use
+        '''
+        User.objects.filter(pk=self.pk).update(credential_generation=F('credential_generation') + 1)
+        self.refresh_from_db(fields=['credential_generation'])
+        # update() sends no post_save
+        signed_token_users.delete(str(self.pk))
+        if legacy_tokens_enabled():
+            Token.objects.filter(user=self).delete()
 
 '''
 Generates a token whenever an superuser is created through createsuperuser
@@ -14,4 +93,26 @@ Generates a token whenever an superuser is created through createsuperuser
 @receiver(post_save, sender=User)
 def set_auth_token(sender, instance=None, created=False, **kwargs):
     if created and instance.is_staff:
-        instance.set_auth_token()
\ No newline at end of file
+        instance.set_auth_token()
+
+'''
+Keeps CachedTokenAuthentication from serving a token
+that was replaced (set_auth_token) or deleted (change_password),
+or a stale copy of a user that was modified
+'''
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def evict_cached_token(sender, instance=None, **kwargs):
+    token_cache.evict_token(instance.key)
+
+'''
+Modified or deleted users are also dropped from the caches of
+the token authentications, change_password included as it saves
+the user. Representations are cached by version, see
+CachedRepresentationMixin, so saves leave them behind.
+'''
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def evict_cached_user(sender, instance=None, **kwargs):
+    token_cache.evict_user(instance.pk)
+    signed_token_users.delete(str(instance.pk))
@@ -0,0 +1,12 @@
+from rest_framework.pagination import CursorPagination
+
+class UserCursorPagination(CursorPagination):
+    '''
+    Keyset pagination on id, every page is read with
+    WHERE id > cursor instead of an OFFSET scan,
+    so deep pages cost the same as the first one
+    '''
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
@@ -0,0 +1,144 @@
+'''
+Compact on-disk index of breached passwords.
+
+The index is a sorted array of fixed-size SHA-1 prefixes,
+looked up with a binary search over a read-only mmap, so every
+worker process shares the same pages through the page cache
+instead of loading the corpus into its own memory.
+'''
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 64 bits of SHA-1, false positives are negligible for corpora of billions
+DIGEST_SIZE = 8
+
+def password_digest(password):
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    return hashlib.sha1(password).digest()[:DIGEST_SIZE]
+
+def sha1_hex_digest(line):
+    '''
+    Digest of a line holding a hex SHA-1, optionally
+    followed by :count as in the Pwned Passwords dumps
+    '''
+    return bytes.fromhex(line.split(b':', 1)[0].strip()[:DIGEST_SIZE * 2].decode('ascii'))
+
+class PasswordIndex(object):
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            size = os.fstat(index_file.fileno()).st_size
+            self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._count = size // DIGEST_SIZE
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, digest):
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * DIGEST_SIZE
+            # Big-endian bytes compare in numeric order
+            current = self._map[offset:offset + DIGEST_SIZE]
+            if current < digest:
+                low = middle + 1
+            elif current > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def open_index(path):
+    '''
+    The index at path, opened once per process and opened
+    again when the file changes, e.g. built or rebuilt by
+    build_password_index. None while it hasn't been built
+    or can't be read, passwords then go unscreened.
+    '''
+    error = None
+    try:
+        stat = os.stat(path)
+        # build_index swaps in a new file, with its own inode,
+        # and fixed permissions are picked up through the mode
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_mode)
+    except OSError as stat_error:
+        identity, error = None, stat_error
+    with _indexes_lock:
+        cached = _indexes.get(path)
+        if cached is None or cached[0] != identity:
+            index = None
+            if identity is not None:
+                try:
+                    index = PasswordIndex(path)
+                except OSError as open_error:
+                    error = open_error
+            if index is None and (cached is None or cached[1] is not None):
+                if isinstance(error, FileNotFoundError):
+                    logger.warning('Breached password index %s not found, run build_password_index.', path)
+                else:
+                    logger.error('Breached password index %s could not be opened: %s', path, error)
+            _indexes[path] = cached = (identity, index)
+        return cached[1]
+
+def _read_run(run_file):
+    run_file.seek(0)
+    while True:
+        block = run_file.read(DIGEST_SIZE * 8192)
+        if not block:
+            return
+        for offset in range(0, len(block), DIGEST_SIZE):
+            yield block[offset:offset + DIGEST_SIZE]
+
+def _write_run(digests):
+    digests.sort()
+    run_file = tempfile.TemporaryFile()
+    run_file.write(b''.join(digests))
+    return run_file
+
+def build_index(lines, output, digest=password_digest, chunk_size=1000000):
+    '''
+    Writes the sorted, deduplicated digests of lines to output.
+    Sorts chunk_size lines at a time and merges the sorted
+    runs, so memory doesn't grow with the corpus.
+    The file is swapped in atomically, workers switch to
+    it on their next lookup (see open_index).
+    Returns the number of digests written.
+    '''
+    runs = []
+    digests = []
+    for line in lines:
+        line = line.rstrip(b'\r\n')
+        if line:
+            digests.append(digest(line))
+        if len(digests) >= chunk_size:
+            runs.append(_write_run(digests))
+            digests = []
+    if digests:
+        runs.append(_write_run(digests))
+
+    count = 0
+    previous = None
+    directory = os.path.dirname(os.path.abspath(output))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as index_file:
+        for current in heapq.merge(*(_read_run(run) for run in runs)):
+            if current != previous:
+                index_file.write(current)
+                count += 1
+                previous = current
+    # Readable by the app, which may run as another user
+    os.chmod(index_file.name, 0o644)
+    os.replace(index_file.name, output)
+    for run in runs:
+        run.close()
+    return count
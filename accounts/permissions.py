@@ -1,27 +1,40 @@
-from django.contrib.auth import get_user_model
-from django.shortcuts import get_object_or_404
-
 from rest_framework import permissions
 
-User = get_user_model()
+def requests_self(request, view):
+    '''
+    Check if the lookup in the requested view's URL
+    is the requesting user's own pk. Needs no query.
+    '''
+    lookup_url_kwarg = view.lookup_url_kwarg or view.lookup_field
+    return bool(
+        request.user and request.user.is_authenticated and
+        str(view.kwargs.get(lookup_url_kwarg)) == str(request.user.pk)
+    )
 
 class IsSelf(permissions.BasePermission):
     '''
     Check if the user requesting the action is
     the same one in the requested view.
-    Returns False if the requested user don't
-    exist.
+    The object is loaded only once by the view's
+    get_object(), which calls has_object_permission.
+    Other pks get a 403 whether or not the user
+    exists, so they can't be probed.
     '''
     def has_permission(self, request, view):
-        requested_user = get_object_or_404(User, pk=view.kwargs.get('pk'))
-        return request.user and (request.user.id == requested_user.id)
+        return requests_self(request, view)
+
+    def has_object_permission(self, request, view, obj):
+        return request.user.pk == obj.pk
 
 class IsAdminOrSelf(permissions.BasePermission):
     '''
     Check if the user requesting the action is
     the same one in the requested view or an admin.
-    Returns False if the requested user don't
-    exist.
+    Admins get a 404 from get_object() if the
+    requested user don't exist, other users a 403.
     '''
     def has_permission(self, request, view):
-        return IsSelf().has_permission(request, view) or request.user.is_staff
\ No newline at end of file
+        return request.user.is_staff or requests_self(request, view)
+
+    def has_object_permission(self, request, view, obj):
+        return request.user.is_staff or request.user.pk == obj.pk
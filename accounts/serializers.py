@@ -1,29 +1,47 @@
 from django.contrib.auth import get_user_model
 import django.contrib.auth.password_validation as validators
+from django.contrib.auth.validators import UnicodeUsernameValidator
 from rest_framework import serializers
 
 User = get_user_model()
 
 class UserSerializer(serializers.ModelSerializer):
     def validate_password(self, data):
-        return PasswordSerializer(data={'password': data})
-
-    def create(self, validated_data):
-        user = super(UserSerializer, self).create(validated_data)
         '''
-        Extract the password serializer from 
-        validated_data and check if it's ok
+        Validate the password up front, so an invalid
+        one is rejected before anything is written
         '''
-        password_serializer = validated_data.get('password')
-        password_serializer.is_valid(raise_exception=True)
+        password_serializer = PasswordSerializer(data={'password': data})
+        if not password_serializer.is_valid():
+            raise serializers.ValidationError(password_serializer.errors['password'])
+        return password_serializer.validated_data['password']
+
+    def create(self, validated_data):
         '''
-        Everything is fine, set the validated password to the created user
+        Hash the password before the user is
+        inserted, so it's saved only once
         '''
-        password = password_serializer.validated_data.get('password')
+        password = validated_data.pop('password')
+        user = User(**validated_data)
         user.set_password(password)
         user.save()
         return user
 
+    def update(self, instance, validated_data):
+        '''
+        Save only the fields sent, so concurrent
+        changes to the others aren't overwritten
+        '''
+        password = validated_data.pop('password', None)
+        update_fields = list(validated_data)
+        if password is not None:
+            instance.set_password(password)
+            update_fields.append('password')
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=update_fields)
+        return instance
+
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'password']
@@ -31,6 +49,17 @@ class UserSerializer(serializers.ModelSerializer):
             'password': {'write_only': True},
         }
 
+class BulkUserSerializer(UserSerializer):
+    '''
+    UserSerializer without the per-row username uniqueness
+    query, bulk provisioning checks usernames in batches
+    '''
+    class Meta(UserSerializer.Meta):
+        extra_kwargs = dict(
+            UserSerializer.Meta.extra_kwargs,
+            username={'validators': [UnicodeUsernameValidator()]},
+        )
+
 class PasswordSerializer(serializers.Serializer):
     password = serializers.CharField(required=True)
 
@@ -1,13 +1,58 @@
+import asyncio
+import hashlib
 import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from io import StringIO
+from unittest.mock import patch
+
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase, APITransactionTestCase
 from rest_framework.authtoken.models import Token
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
+from django.core.wsgi import get_wsgi_application
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from utils import metrics
+from utils.asgi import WSGIToASGI
+from utils.cache import ConfiguredCache
+from utils.db.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from utils.filters import IndexedFilterBackend, IndexedSearchFilter
+from utils.models import VersionConflict
+from utils.profiling import profile_token
+from utils.serializers import ValuesSerializer
+from utils.testing import QueryBudgetTestMixin
+
+from .authentication import TokenCache, signed_token_users, token_cache
+from .caches import representation_cache
+from .hashing import HashingUnavailable, hash_passwords, hash_seconds
+from .password_index import open_index
+from .throttles import TokenBucketThrottle, bucket_store, throttled
+from .serializers import UserSerializer
+from .validators import BreachedPasswordValidator
+from .views import UserViewSet
 
 User = get_user_model()
 
-class AccountTestCase(APITestCase):
+class AccountTestCase(QueryBudgetTestMixin, APITestCase):
+    def setUp(self):
+        bucket_store.clear()
+
     def test_user_creation(self):
         '''Ensure we can create a new user via API'''
         response = self.client.post(
@@ -139,4 +184,1368 @@ class AccountTestCase(APITestCase):
             content_type='application/json'
         )
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
-        
\ No newline at end of file
+
+    def test_actions_make_their_declared_queries(self):
+        '''Ensure every action makes exactly the queries UserViewSet declares'''
+        admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        Token.objects.create(user=user)
+        self.client.force_authenticate(user=admin)
+
+        with self.assertActionQueries(UserViewSet, 'list'):
+            self.client.get('/users/')
+        with self.assertActionQueries(UserViewSet, 'retrieve'):
+            self.client.get('/users/{}/'.format(user.id))
+        with self.assertActionQueries(UserViewSet, 'update'):
+            self.client.put(
+                '/users/{}/'.format(user.id),
+                json.dumps({'username': 'new_username', 'email': 'new@username.com', 'password': 'picapau@#'}),
+                content_type='application/json'
+            )
+        with self.assertActionQueries(UserViewSet, 'partial_update'):
+            self.client.patch(
+                '/users/{}/'.format(user.id),
+                json.dumps({'email': 'other@username.com'}),
+                content_type='application/json'
+            )
+
+        self.client.force_authenticate(user=user)
+        with self.assertActionQueries(UserViewSet, 'change_password'):
+            self.client.post(
+                '/users/{}/change_password/'.format(user.id),
+                json.dumps({'password': 'popcorn00'}),
+                content_type='application/json'
+            )
+
+        self.client.force_authenticate(user=admin)
+        with self.assertActionQueries(UserViewSet, 'destroy'):
+            self.client.delete('/users/{}/'.format(user.id))
+
+        self.client.force_authenticate(user=None)
+        with self.assertActionQueries(UserViewSet, 'create'):
+            self.client.post(
+                '/users/',
+                json.dumps({'username': 'created', 'email': 'created@username.com', 'password': 'picapau@#'}),
+                content_type='application/json'
+            )
+
+    def test_queries_are_reported(self):
+        '''Ensure responses carry their database time and requests over budget are logged'''
+        user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.client.force_authenticate(user=user)
+        response = self.client.get('/users/{}/'.format(user.id))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="1 queries", total;dur=[\d.]+$')
+
+        another = User.objects.create_user('another_user', 'another@user.com', 'test123')
+        self.client.force_authenticate(user=another)
+        budgets = dict(UserViewSet.query_budget_by_action, partial_update=-2)
+        with patch.object(UserViewSet, 'query_budget_by_action', budgets):
+            with self.assertLogs('utils.middleware', 'WARNING'):
+                self.client.patch(
+                    '/users/{}/'.format(another.id),
+                    json.dumps({'email': 'other@username.com'}),
+                    content_type='application/json'
+                )
+
+class TokenCacheTestCase(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.token = Token.objects.create(user=self.user).key
+        self.client.credentials(HTTP_AUTHORIZATION='Token {}'.format(self.token))
+
+    def token_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/users/{}/'.format(self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [query for query in context.captured_queries if 'authtoken_token' in query['sql']]
+
+    def test_repeat_requests_make_no_auth_queries(self):
+        '''Ensure only the first request with a token hits the token table'''
+        self.assertEqual(len(self.token_queries()), 1)
+        self.assertEqual(self.token_queries(), [])
+        self.assertEqual(self.token_queries(), [])
+
+    def test_cached_users_have_no_password(self):
+        '''Ensure the cached snapshot leaves out the password hash, deferring it on restore'''
+        self.token_queries()
+        user_values, _ = token_cache.get(self.token)
+        self.assertNotIn(self.user.password, user_values)
+        user, _ = token_cache.get_credentials(self.token, Token)
+        self.assertIn('password', user.get_deferred_fields())
+        self.assertTrue(user.check_password('test123'))
+
+    def test_new_token_evicts_cached_one(self):
+        '''Ensure a token replaced through set_auth_token is no longer accepted'''
+        self.token_queries()
+        Token.objects.get(user=self.user).delete()
+        new_token = self.user.set_auth_token()['token']
+        response = self.client.get('/users/{}/'.format(self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token {}'.format(new_token))
+        response = self.client.get('/users/{}/'.format(self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_user_changes_evict_cached_token(self):
+        '''Ensure a deactivated user can't keep using a cached token'''
+        self.token_queries()
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get('/users/{}/'.format(self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(
+        CACHES=dict(settings.CACHES, shared={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}),
+        TOKEN_AUTH_CACHE=dict(settings.TOKEN_AUTH_CACHE, CACHE_ALIAS='shared'),
+    )
+    def test_deleted_token_is_evicted_from_every_worker(self):
+        '''Ensure a token deleted in one worker is no longer served from another one's cache'''
+        worker, other_worker = TokenCache(), TokenCache()
+        # clear() only drops local entries, start from an empty shared backend
+        caches['shared'].clear()
+        token = Token.objects.get(key=self.token)
+        other_worker.set_credentials(self.user, token)
+        self.assertEqual(worker.get_credentials(self.token, Token)[0].pk, self.user.pk)
+        self.assertEqual(other_worker.get_credentials(self.token, Token)[0].pk, self.user.pk)
+
+        worker.evict_token(self.token)
+        self.assertIsNone(other_worker.get_credentials(self.token, Token))
+
+class SignedTokenTestCase(APITestCase):
+    def setUp(self):
+        bucket_store.clear()
+        signed_token_users.clear()
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+
+    def obtain(self, password='test123'):
+        self.client.credentials()
+        response = self.client.post(
+            '/get_auth_token/',
+            json.dumps({'username': 'test_username', 'password': password}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def retrieve(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION='Token {}'.format(token))
+        return self.client.get('/users/{}/'.format(self.user.id))
+
+    def test_both_formats_are_issued(self):
+        '''Ensure signed tokens are issued along with authtoken ones during the migration'''
+        tokens = self.obtain()
+        self.assertEqual(tokens['token'], Token.objects.get(user=self.user).key)
+        self.assertEqual(self.retrieve(tokens['token']).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.retrieve(tokens['signed_token']).status_code, status.HTTP_200_OK)
+
+    def test_signed_tokens_skip_the_database(self):
+        '''Ensure repeat requests with a signed token make no authentication queries'''
+        token = self.obtain()['signed_token']
+        self.retrieve(token)
+        with CaptureQueriesContext(connection) as context:
+            response = self.retrieve(token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The view's own read of the requested user
+        self.assertEqual(len(context.captured_queries), 1)
+
+    def test_cached_users_have_no_password(self):
+        '''Ensure users cached for signed tokens leave out the password hash'''
+        self.assertEqual(self.retrieve(self.obtain()['signed_token']).status_code, status.HTTP_200_OK)
+        values = signed_token_users.get(str(self.user.pk))
+        self.assertIsNotNone(values)
+        self.assertNotIn(User.objects.get(pk=self.user.pk).password, values)
+
+    def test_invalid_signed_tokens_are_rejected(self):
+        '''Ensure signed tokens naming another user, or expired, are rejected'''
+        token = self.obtain()['signed_token']
+        user_pk, rest = token.split(':', 1)
+        response = self.retrieve('{}:{}'.format(int(user_pk) + 1, rest))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        with self.settings(SIGNED_TOKENS=dict(settings.SIGNED_TOKENS, MAX_AGE=-1)):
+            expired = self.obtain()['signed_token']
+        response = self.retrieve(expired)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data['detail'], 'Token has expired.')
+
+    def test_password_change_revokes_signed_tokens(self):
+        '''Ensure a password change bumps the generation, revoking earlier tokens'''
+        old_token = self.obtain()['signed_token']
+        self.retrieve(old_token)
+        response = self.client.post(
+            '/users/{}/change_password/'.format(self.user.id),
+            json.dumps({'password': 'picapau@#'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.retrieve(old_token).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.retrieve(response.data['signed_token']).status_code, status.HTTP_200_OK)
+
+    def test_stale_instances_revoke_signed_tokens(self):
+        '''Ensure revoking through an instance read before another revocation still counts'''
+        stale = User.objects.get(pk=self.user.pk)
+        self.user.revoke_auth_tokens()
+        stale.revoke_auth_tokens()
+        self.assertEqual(stale.credential_generation, self.user.credential_generation + 1)
+        self.assertEqual(User.objects.get(pk=self.user.pk).credential_generation, stale.credential_generation)
+
+    @override_settings(
+        CACHES=dict(settings.CACHES, shared={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}),
+        SIGNED_TOKENS=dict(settings.SIGNED_TOKENS, CACHE_ALIAS='shared'),
+    )
+    def test_password_change_evicts_user_from_every_worker(self):
+        '''Ensure another worker stops serving the user of revoked signed tokens'''
+        other_worker = ConfiguredCache('SIGNED_TOKENS', 'signed-token-user')
+        # signed_token_users.clear() in setUp leaves shared entries
+        caches['shared'].clear()
+        token = self.obtain()['signed_token']
+        self.assertEqual(self.retrieve(token).status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(other_worker.get(str(self.user.pk)))
+        self.user.revoke_auth_tokens()
+        self.assertIsNone(other_worker.get(str(self.user.pk)))
+        self.assertEqual(self.retrieve(token).status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(SIGNED_TOKENS=dict(settings.SIGNED_TOKENS, LEGACY_TOKENS=False))
+    def test_legacy_tokens_can_be_turned_off(self):
+        '''Ensure no token rows are written once legacy tokens are off'''
+        token = self.obtain()['signed_token']
+        response = self.client.post(
+            '/users/',
+            json.dumps({'username': 'another', 'email': 'another@user.com', 'password': 'picapau@#'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('token', response.data)
+        self.assertIn('signed_token', response.data)
+
+        with CaptureQueriesContext(connection) as context:
+            self.retrieve(token)
+            response = self.client.post(
+                '/users/{}/change_password/'.format(self.user.id),
+                json.dumps({'password': 'picapau@#'}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data), ['signed_token'])
+        self.assertFalse(any('authtoken_token' in query['sql'] for query in context.captured_queries))
+        self.assertFalse(Token.objects.exists())
+
+class BatchTestCase(APITestCase):
+    def setUp(self):
+        bucket_store.clear()
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.token = Token.objects.create(user=self.user).key
+        self.client.credentials(HTTP_AUTHORIZATION='Token {}'.format(self.token))
+
+    def batch(self, subrequests, query=''):
+        return self.client.post('/batch/' + query, json.dumps(subrequests), content_type='application/json')
+
+    def test_subrequests_get_their_own_status(self):
+        '''Ensure each sub-request gets its own status, headers and body'''
+        response = self.batch([
+            {'path': '/users/{}/'.format(self.user.id)},
+            {'path': '/users/'},
+            {'method': 'POST', 'path': '/users/{}/change_password/'.format(self.user.id), 'body': {'password': 'picapau@#'}},
+            {'path': '/nowhere/'},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data
+        self.assertEqual([result['status'] for result in results], [200, 403, 200, 404])
+        self.assertEqual(results[0]['body']['username'], 'test_username')
+        self.assertIn('ETag', results[0]['headers'])
+        self.assertNotEqual(results[2]['body']['token'], self.token)
+
+    def test_authentication_is_resolved_once(self):
+        '''Ensure sub-requests reuse the batch request's authentication'''
+        with CaptureQueriesContext(connection) as context:
+            response = self.batch([{'path': '/users/{}/'.format(self.user.id)}] * 3)
+        self.assertEqual([result['status'] for result in response.data], [200] * 3)
+        self.assertEqual(len([query for query in context.captured_queries if 'authtoken_token' in query['sql']]), 1)
+
+    def test_subrequest_headers(self):
+        '''Ensure sub-requests can send headers, but not credentials'''
+        etag = self.client.get('/users/{}/'.format(self.user.id))['ETag']
+        response = self.batch([
+            {'path': '/users/{}/'.format(self.user.id), 'headers': {'If-None-Match': etag}},
+            # Credentials come from the batch request only
+            {'path': '/users/{}/'.format(self.user.id), 'headers': {'Authorization': 'Token invalid'}},
+        ])
+        self.assertEqual([result['status'] for result in response.data], [304, 200])
+        self.assertIsNone(response.data[0]['body'])
+
+    def test_invalid_batches(self):
+        '''Ensure malformed, oversized and nested batches are rejected'''
+        self.assertEqual(self.batch({'path': '/users/'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.batch([{'path': 'users/'}]).status_code, status.HTTP_400_BAD_REQUEST)
+        with self.settings(BATCH_REQUESTS=dict(settings.BATCH_REQUESTS, MAX_REQUESTS=2)):
+            self.assertEqual(self.batch([{'path': '/users/'}] * 3).status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.batch([{'method': 'POST', 'path': '/batch/', 'body': []}])
+        self.assertEqual(response.data[0]['status'], status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(REST_FRAMEWORK=dict(
+        settings.REST_FRAMEWORK,
+        DEFAULT_THROTTLE_RATES=dict(settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], credentials_ip='3/min'),
+    ))
+    def test_subrequests_are_throttled_as_the_batch_client(self):
+        '''Ensure sub-requests can't rotate X-Forwarded-For or Host to dodge the IP throttle'''
+        response = self.batch([
+            {
+                'method': 'POST', 'path': '/get_auth_token/',
+                'body': {'username': 'user_{}'.format(i), 'password': 'wrong'},
+                'headers': {'X-Forwarded-For': '10.0.0.{}'.format(i), 'Host': 'host{}.example.com'.format(i)},
+            }
+            for i in range(4)
+        ])
+        statuses = [result['status'] for result in response.data]
+        self.assertEqual(statuses, [400] * 3 + [status.HTTP_429_TOO_MANY_REQUESTS])
+
+class ParallelBatchTestCase(APITransactionTestCase):
+    def test_parallel_batch(self):
+        '''Ensure ?parallel=1 answers every sub-request, in order'''
+        users = [User.objects.create_user('user_{}'.format(i), 'user_{}@user.com'.format(i), 'test123') for i in range(4)]
+        admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        self.client.force_authenticate(user=admin)
+        response = self.client.post(
+            '/batch/?parallel=1',
+            json.dumps([{'path': '/users/{}/'.format(user.id)} for user in users]),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['status'] for result in response.data], [200] * 4)
+        self.assertEqual([result['body']['username'] for result in response.data], [user.username for user in users])
+
+class ASGITestCase(APITransactionTestCase):
+    def setUp(self):
+        self.application = WSGIToASGI(get_wsgi_application(), threads=2, buffered_chunks=2)
+        self.addCleanup(self.application.executor.shutdown)
+
+    def call(self, method, path, body=b'', headers=(), query_string=b'', read=None):
+        '''
+        Sends body in two messages and returns the status,
+        headers and body received, reading at most read body messages
+        '''
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+            'headers': [(b'host', b'testserver'), (b'content-type', b'application/json')] + list(headers),
+        }
+        requests = [
+            {'type': 'http.request', 'body': body[:1], 'more_body': True},
+            {'type': 'http.request', 'body': body[1:], 'more_body': False},
+        ]
+        messages = []
+
+        async def receive():
+            return requests.pop(0)
+
+        async def send(message):
+            if read is not None and len(messages) > read:
+                raise ConnectionResetError()
+            messages.append(message)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.application(scope, receive, send))
+        finally:
+            loop.close()
+        start, body_messages = messages[0], messages[1:]
+        return start['status'], dict(start['headers']), b''.join(message['body'] for message in body_messages)
+
+    def test_requests(self):
+        '''Ensure a user can be created, then retrieved with its token, over ASGI'''
+        body = json.dumps({'username': 'test_username', 'email': 'test@username.com', 'password': 'picapau@#'})
+        status_code, headers, content = self.call('POST', '/users/', body.encode())
+        self.assertEqual(status_code, status.HTTP_201_CREATED, content)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+        token = json.loads(content.decode())['token']
+
+        user = User.objects.get(username='test_username')
+        status_code, _, content = self.call(
+            'GET', '/users/{}/'.format(user.id), headers=[(b'authorization', 'Token {}'.format(token).encode())]
+        )
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(content.decode())['username'], 'test_username')
+
+    def test_streamed_responses(self):
+        '''Ensure streamed responses are passed on, and stopped when the client leaves'''
+        admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        User.objects.bulk_create(User(username='user_{}'.format(i)) for i in range(30))
+        authorization = (b'authorization', 'Token {}'.format(Token.objects.get(user=admin).key).encode())
+        status_code, _, content = self.call('GET', '/users/export/', headers=[authorization], query_string=b'type=csv')
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(len(content.decode().splitlines()), 32)
+
+        with self.assertRaises(ConnectionResetError):
+            self.call('GET', '/users/export/', headers=[authorization], query_string=b'type=csv', read=1)
+
+class SQLiteBackendTestCase(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'db.sqlite3')
+
+    def wrapper(self, **options):
+        options.setdefault('pragmas', {'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -2048})
+        wrapper = SQLiteDatabaseWrapper(dict(
+            settings.DATABASES['default'], NAME=self.path, CONN_MAX_AGE=60, OPTIONS=options,
+        ), alias='sqlite_backend_test')
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute('PRAGMA {}'.format(name))
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        '''Ensure the pragmas are set on connect, and only valid ones are accepted'''
+        wrapper = self.wrapper()
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)
+        self.assertEqual(self.pragma(wrapper, 'cache_size'), -2048)
+        with self.assertRaises(ImproperlyConfigured):
+            self.wrapper(pragmas={'journal_mode': 'wal; DROP TABLE users'})
+        with self.assertRaises(ImproperlyConfigured):
+            self.wrapper(timeout=5, pragmas={'busy_timeout': 5000})
+
+    def lock(self):
+        '''
+        Creates a table and takes the write lock from another
+        connection, returning the function releasing it
+        '''
+        writer = self.wrapper()
+        with writer.cursor() as cursor:
+            cursor.execute('CREATE TABLE items (id INTEGER PRIMARY KEY)')
+            cursor.execute('BEGIN IMMEDIATE')
+        return writer.connection.commit
+
+    def test_locked_database_is_waited_for(self):
+        '''Ensure a statement waits for the lock to be released within busy_timeout'''
+        threading.Timer(.2, self.lock()).start()
+        waiting = self.wrapper(pragmas={'busy_timeout': 5000})
+        with waiting.cursor() as cursor:
+            cursor.execute('INSERT INTO items VALUES (1)')
+            cursor.execute('SELECT COUNT(*) FROM items')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_lock_wait_is_bounded(self):
+        '''Ensure a statement fails once it has waited busy_timeout for the lock'''
+        self.addCleanup(self.lock())
+        waiting = self.wrapper(pragmas={'busy_timeout': 100})
+        start = time.perf_counter()
+        with self.assertRaisesRegex(OperationalError, 'locked'):
+            waiting.cursor().execute('INSERT INTO items VALUES (1)')
+        self.assertGreaterEqual(time.perf_counter() - start, .09)
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_broken_connections_are_replaced(self):
+        '''Ensure a persistent connection closed behind Django's back is replaced'''
+        wrapper = self.wrapper(health_checks=True)
+        self.pragma(wrapper, 'journal_mode')
+        stale = wrapper.connection
+        self.pragma(wrapper, 'journal_mode')
+        self.assertIs(wrapper.connection, stale)
+        # Closed behind Django's back
+        stale.close()
+        wrapper.close_if_unusable_or_obsolete()
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertIsNot(wrapper.connection, stale)
+
+class DetailQueriesTestCase(APITestCase):
+    '''
+    Ensure the requested user is loaded at most once, from its
+    row even when it's the requesting user, and not at all
+    when the permissions already rule the request out
+    '''
+    def setUp(self):
+        bucket_store.clear()
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        Token.objects.create(user=self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def user_lookups(self, context):
+        return [
+            query for query in context.captured_queries
+            if query['sql'].startswith('SELECT') and 'FROM "accounts_user"' in query['sql']
+        ]
+
+    def test_retrieve_self(self):
+        '''Ensure an user retrieving itself reads its row once'''
+        with self.assertNumQueries(1):
+            response = self.client.get('/users/{}/'.format(self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_retrieve_another(self):
+        '''Ensure an user retrieving another is refused without any query'''
+        another = User.objects.create_user('another_user', 'another@user.com', 'test123')
+        with self.assertNumQueries(0):
+            response = self.client.get('/users/{}/'.format(another.id))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_missing_users_are_forbidden(self):
+        '''Ensure a missing user gets the same 403 as an existing one, only admins see the 404'''
+        missing = '/users/{}/'.format(self.user.id + 1000)
+        with self.assertNumQueries(0):
+            response = self.client.get(missing)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.post(missing + 'change_password/', json.dumps({'password': 'picapau@#'}), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=User.objects.create_superuser('admin', 'admin@admin.com', 'test123'))
+        self.assertEqual(self.client.get(missing).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_admin_retrieve_another(self):
+        '''Ensure an admin retrieving another user reads its row once'''
+        admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        self.client.force_authenticate(user=admin)
+        with self.assertNumQueries(1):
+            response = self.client.get('/users/{}/'.format(self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_update_self(self):
+        '''Ensure an update reads the user once before checking and saving it'''
+        # SELECT user + username uniqueness check,
+        # UPDATE version + UPDATE user in a savepoint
+        with self.assertNumQueries(6):
+            response = self.client.put(
+                '/users/{}/'.format(self.user.id),
+                json.dumps({'username': 'new_username', 'email': 'new@username.com', 'password': 'picapau@#'}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_partial_update_self(self):
+        '''Ensure a partial update reads the user once before saving it'''
+        # SELECT user, UPDATE version + UPDATE user in a savepoint
+        with self.assertNumQueries(5):
+            response = self.client.patch(
+                '/users/{}/'.format(self.user.id),
+                json.dumps({'email': 'new@username.com'}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_partial_update_another(self):
+        '''Ensure an user updating another is refused without any query'''
+        another = User.objects.create_user('another_user', 'another@user.com', 'test123')
+        with self.assertNumQueries(0):
+            response = self.client.patch(
+                '/users/{}/'.format(another.id),
+                json.dumps({'email': 'new@username.com'}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_change_password_self(self):
+        '''Ensure a password change reads the user once before saving it'''
+        # SELECT user, UPDATE + SELECT credential_generation, SELECT +
+        # DELETE old token, UPDATE version + UPDATE user, INSERT new
+        # token, in savepoints
+        with self.assertNumQueries(12):
+            response = self.client.post(
+                '/users/{}/change_password/'.format(self.user.id),
+                json.dumps({'password': 'picapau@#'}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_destroy_self(self):
+        '''Ensure deleting itself reads the user's row once'''
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.delete('/users/{}/'.format(self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(self.user_lookups(context)), 1)
+
+    def test_cached_requesting_user_is_not_used_as_data(self):
+        '''Ensure a stale snapshot from the token cache is neither served nor written back'''
+        token_cache.clear()
+        representation_cache.clear()
+        self.client.force_authenticate(user=None)
+        self.client.credentials(HTTP_AUTHORIZATION='Token {}'.format(Token.objects.get(user=self.user).key))
+        self.client.get('/users/{}/'.format(self.user.id))
+        # Changed by another worker, the token cache still has the old row
+        User.objects.filter(pk=self.user.pk).update(
+            email='concurrent@username.com', first_name='Concurrent', version=F('version') + 1
+        )
+
+        response = self.client.get('/users/{}/'.format(self.user.id))
+        self.assertEqual(json.loads(response.content.decode())['email'], 'concurrent@username.com')
+        response = self.client.patch(
+            '/users/{}/'.format(self.user.id),
+            json.dumps({'username': 'new_username'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual((user.username, user.first_name), ('new_username', 'Concurrent'))
+
+class UserCreationTestCase(APITestCase):
+    def create_user(self, password):
+        return self.client.post(
+            '/users/',
+            json.dumps({'username': 'test_username', 'email': 'test@username.com', 'password': password}),
+            content_type='application/json'
+        )
+
+    def test_creation_statements(self):
+        '''Ensure signup checks the username and then writes the user and its token once each'''
+        with CaptureQueriesContext(connection) as context:
+            response = self.create_user('picapau@#')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        statements = [
+            query['sql'].split()[0] for query in context.captured_queries
+            if not query['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))
+        ]
+        self.assertEqual(statements, ['SELECT', 'INSERT', 'INSERT'])
+
+        user = User.objects.get(username='test_username')
+        self.assertTrue(user.check_password('picapau@#'))
+        self.assertEqual(response.data.get('id'), user.id)
+        self.assertEqual(response.data.get('token'), Token.objects.get(user=user).key)
+
+    def test_invalid_password_creates_nothing(self):
+        '''Ensure a rejected password doesn't leave a user behind'''
+        response = self.create_user('test123')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('password', response.data)
+        self.assertFalse(User.objects.exists())
+
+class BulkCreationTestCase(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        self.client.force_authenticate(user=admin)
+
+    def test_bulk_creation(self):
+        '''Ensure an admin can create many users along with their tokens'''
+        rows = [
+            {'username': 'user_{}'.format(i), 'email': 'user_{}@user.com'.format(i), 'password': 'picapau@#{}'.format(i)}
+            for i in range(10)
+        ]
+        response = self.client.post('/users/bulk/', json.dumps(rows), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['created']), 10)
+        self.assertEqual(response.data['errors'], [])
+
+        created = response.data['created'][3]
+        user = User.objects.get(username='user_3')
+        self.assertEqual(created['id'], user.id)
+        self.assertEqual(created['token'], Token.objects.get(user=user).key)
+        self.assertTrue(user.check_password('picapau@#3'))
+
+    def test_bulk_creation_reports_row_errors(self):
+        '''Ensure invalid and duplicated rows are reported while the others are created'''
+        User.objects.create_user('taken', 'taken@user.com', 'test123')
+        body = '\n'.join(json.dumps(row) for row in [
+            {'username': 'first', 'email': 'first@user.com', 'password': 'picapau@#'},
+            {'username': 'taken', 'email': 'taken2@user.com', 'password': 'picapau@#'},
+            {'username': 'short', 'email': 'short@user.com', 'password': '123'},
+            {'username': 'first', 'email': 'first2@user.com', 'password': 'picapau@#'},
+        ])
+        response = self.client.post('/users/bulk/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([row['username'] for row in response.data['created']], ['first'])
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2, 3])
+        self.assertIn('password', response.data['errors'][1]['errors'])
+
+    def test_usernames_taken_concurrently_are_reported(self):
+        '''Ensure a username taken between the check and the insert only fails its own row'''
+        def hash_passwords_racing(passwords):
+            # Another request creates the user once the usernames were checked
+            User.objects.create_user('racer', 'racer@user.com', 'test123')
+            return hash_passwords(passwords)
+
+        rows = [
+            {'username': name, 'email': '{}@user.com'.format(name), 'password': 'picapau@#'}
+            for name in ('first', 'racer', 'third')
+        ]
+        with patch('accounts.bulk.hash_passwords', hash_passwords_racing):
+            response = self.client.post('/users/bulk/', json.dumps(rows), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([row['username'] for row in response.data['created']], ['first', 'third'])
+        self.assertEqual([error['index'] for error in response.data['errors']], [1])
+        self.assertIn('username', response.data['errors'][0]['errors'])
+
+    def test_bulk_hashing_takes_queue_slots(self):
+        '''Ensure bulk hashing is turned away like other operations once the queue is full'''
+        rows = [
+            {'username': 'user_{}'.format(i), 'email': 'user_{}@user.com'.format(i), 'password': 'picapau@#{}'.format(i)}
+            for i in range(10)
+        ]
+        saturated = dict(settings.PASSWORD_HASHING, WORKERS=2, MAX_QUEUE=0, RETRY_AFTER=0)
+        with self.settings(PASSWORD_HASHING=saturated):
+            response = self.client.post('/users/bulk/', json.dumps(rows), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(User.objects.filter(username__startswith='user_').exists())
+
+        # Chunks wait for the slot while the first one starts the workers
+        with self.settings(PASSWORD_HASHING=dict(settings.PASSWORD_HASHING, WORKERS=2, MAX_QUEUE=1, RETRY_AFTER=30)):
+            response = self.client.post('/users/bulk/', json.dumps(rows), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(User.objects.get(username='user_9').check_password('picapau@#9'))
+
+    def test_bulk_creation_is_admin_only(self):
+        '''Ensure a regular user can't bulk create users'''
+        user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.client.force_authenticate(user=user)
+        response = self.client.post('/users/bulk/', json.dumps([]), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class UserListTestCase(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        self.client.force_authenticate(user=admin)
+        User.objects.bulk_create(
+            User(username='user_{}'.format(i), email='user_{}@user.com'.format(i)) for i in range(24)
+        )
+
+    def test_list_is_keyset_paginated(self):
+        '''Ensure the list is paged by id without OFFSET scans'''
+        ids = []
+        url = '/users/?page_size=10'
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertFalse(any('OFFSET' in query['sql'] for query in context.captured_queries))
+            ids.extend(user['id'] for user in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(ids, list(User.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_list_can_be_streamed(self):
+        '''Ensure ?stream=1 returns every user as a single JSON array'''
+        response = self.client.get('/users/?stream=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        users = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual(len(users), 25)
+        self.assertEqual(set(users[0]), {'id', 'username', 'email'})
+
+class UserSearchTestCase(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        self.client.force_authenticate(user=admin)
+        User.objects.bulk_create([
+            User(username='alice', email='Alice@Example.com'),
+            User(username='Alfred', email='alfred@example.com'),
+            User(username='bob', email='bob@example.com'),
+        ])
+
+    def usernames(self, query):
+        response = self.client.get('/users/?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted(user['username'] for user in response.data['results'])
+
+    def query_plan(self, backend, query):
+        request = Request(APIRequestFactory().get('/users/?' + query))
+        queryset = backend().filter_queryset(request, User.objects.order_by('id'), UserViewSet(action='list'))
+        sql, params = queryset[:100].query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_filters(self):
+        '''Ensure the list can be filtered on exact, prefix and case insensitive lookups'''
+        self.assertEqual(self.usernames('username=alice'), ['alice'])
+        self.assertEqual(self.usernames('username__startswith=al'), ['alice'])
+        self.assertEqual(self.usernames('username__istartswith=al'), ['Alfred', 'alice'])
+        self.assertEqual(self.usernames('email__iexact=alice@example.com'), ['alice'])
+        self.assertEqual(self.usernames('email=alice@example.com'), [])
+        self.assertEqual(self.usernames('username__istartswith=al&email__startswith=alf'), ['Alfred'])
+
+    def test_search(self):
+        '''Ensure ?search= matches usernames by prefix and emails exactly, ignoring case'''
+        self.assertEqual(self.usernames('search=AL'), ['Alfred', 'alice'])
+        self.assertEqual(self.usernames('search=BOB@example.com'), ['bob'])
+        self.assertEqual(self.usernames('search=carol'), [])
+
+    def test_detail_ignores_filters(self):
+        '''Ensure filters meant for the list don't hide an existing user'''
+        user = User.objects.get(username='bob')
+        for query in ('username=alice', 'search=carol'):
+            response = self.client.get('/users/{}/?{}'.format(user.id, query))
+            self.assertEqual(response.status_code, status.HTTP_200_OK, query)
+
+    def test_lookups_use_indexes(self):
+        '''Ensure every lookup is served by an index instead of a table scan'''
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plans are checked on SQLite')
+        expected = [
+            (IndexedFilterBackend, 'username=alice', 'sqlite_autoindex_accounts_user'),
+            (IndexedFilterBackend, 'username__startswith=al', 'sqlite_autoindex_accounts_user'),
+            (IndexedFilterBackend, 'username__istartswith=al', 'accounts_user_username_lower'),
+            (IndexedFilterBackend, 'email=alice@example.com', 'accounts_user_email_idx'),
+            (IndexedFilterBackend, 'email__startswith=alice', 'accounts_user_email_idx'),
+            (IndexedFilterBackend, 'email__iexact=alice@example.com', 'accounts_user_email_lower'),
+            (IndexedSearchFilter, 'search=al', 'accounts_user_username_lower'),
+            (IndexedSearchFilter, 'search=al', 'accounts_user_email_lower'),
+        ]
+        for backend, query, index in expected:
+            plan = ' '.join(self.query_plan(backend, query))
+            self.assertIn('USING INDEX ' + index, plan.replace('COVERING INDEX', 'INDEX'), query)
+            self.assertNotRegex(plan, r'SCAN (TABLE )?accounts_user($| )(?!USING)', query)
+
+class SearchIndexMigrationsTestCase(APITransactionTestCase):
+    def lower_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'accounts_user' AND name LIKE '%%_lower'"
+            )
+            return sorted(row[0] for row in cursor.fetchall())
+
+    def test_reversed_migrations_keep_the_lower_indexes(self):
+        '''Ensure reversing 0004 leaves the expression indexes 0003 created'''
+        expected = ['accounts_user_email_lower', 'accounts_user_username_lower']
+        self.assertEqual(self.lower_indexes(), expected)
+        self.addCleanup(call_command, 'migrate', 'accounts', verbosity=0)
+        call_command('migrate', 'accounts', '0003', verbosity=0)
+        self.assertEqual(self.lower_indexes(), expected)
+
+class UserExportTestCase(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        self.client.force_authenticate(user=admin)
+
+    def create_users(self, start, count):
+        User.objects.bulk_create(
+            User(username='user_{}'.format(i), email='user_{}@user.com'.format(i))
+            for i in range(start, start + count)
+        )
+
+    def export(self, query=''):
+        response = self.client.get('/users/export/' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson_export(self):
+        '''Ensure every user is exported as a JSON line, resuming after an id'''
+        self.create_users(0, 5)
+        users = [json.loads(line) for line in self.export().splitlines()]
+        self.assertEqual(len(users), 6)
+        self.assertEqual(users[1]['username'], 'user_0')
+        self.assertIn('date_joined', users[1])
+
+        resumed = [json.loads(line) for line in self.export('?after={}'.format(users[3]['id'])).splitlines()]
+        self.assertEqual(resumed, users[4:])
+
+    def test_csv_export(self):
+        '''Ensure users can be exported as CSV with a header'''
+        self.create_users(0, 5)
+        lines = self.export('?type=csv').splitlines()
+        self.assertEqual(lines[0].split(','), list(UserViewSet.export_fields))
+        self.assertEqual(len(lines), 7)
+
+    def test_export_memory_is_bounded(self):
+        '''Ensure exporting four times more users doesn't take much more memory'''
+        def peak_memory():
+            with patch.object(UserViewSet, 'export_batch_size', 100):
+                response = self.client.get('/users/export/')
+                tracemalloc.start()
+                for chunk in response.streaming_content:
+                    pass
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            return peak
+
+        self.create_users(0, 1000)
+        small = peak_memory()
+        self.create_users(1000, 3000)
+        self.assertLess(peak_memory(), small * 2)
+
+    def test_export_is_admin_only(self):
+        '''Ensure a regular user can't export users'''
+        user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.client.force_authenticate(user=user)
+        response = self.client.get('/users/export/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class PasswordHashingTestCase(APITestCase):
+    def setUp(self):
+        bucket_store.clear()
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+
+    def get_auth_token(self):
+        return self.client.post(
+            '/get_auth_token/',
+            json.dumps({'username': 'test_username', 'password': 'test123'}),
+            content_type='application/json'
+        )
+
+    def test_saturated_pool_is_rejected(self):
+        '''Ensure password checks are turned away with a 503 once the queue is full'''
+        saturated = dict(settings.PASSWORD_HASHING, MAX_QUEUE=0, RETRY_AFTER=3)
+        with self.settings(PASSWORD_HASHING=saturated):
+            response = self.get_auth_token()
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response['Retry-After'], '3')
+
+            # Callers outside of rest_framework get a plain exception
+            with self.assertRaises(HashingUnavailable):
+                self.user.check_password('test123')
+            response = self.client.post('/admin/login/', {'username': 'test_username', 'password': 'test123'})
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response['Retry-After'], '3')
+
+    def test_hashing_is_measured(self):
+        '''Ensure hash latency and rejections are exported as metrics'''
+        checks = hash_seconds.get(operation='check')
+        self.assertEqual(self.get_auth_token().status_code, status.HTTP_200_OK)
+        self.assertEqual(hash_seconds.get(operation='check'), checks + 1)
+
+        self.client.force_authenticate(user=User.objects.create_superuser('admin', 'admin@admin.com', 'test123'))
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'password_hash_seconds_count{operation="check"}', response.content)
+        self.assertIn(b'password_hash_queue_depth', response.content)
+
+    @override_settings(METRICS_TOKEN='scraper-token')
+    def test_metrics_are_restricted(self):
+        '''Ensure metrics are only served to staff users and scrapers with the token'''
+        self.assertEqual(self.client.get('/metrics/').status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong-token')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.client.get('/metrics/').status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=None)
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scraper-token')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'password_hash_queue_depth', response.content)
+
+    def test_metrics_can_change_during_a_scrape(self):
+        '''Ensure a scrape renders the values as they were when it started'''
+        counter = metrics.Counter('scrape_test_total', 'Test.')
+        histogram = metrics.Histogram('scrape_test_seconds', 'Test.')
+        self.addCleanup(metrics._registry.remove, counter)
+        self.addCleanup(metrics._registry.remove, histogram)
+
+        counter.inc(scope='first')
+        samples = counter.samples()
+        next(samples)
+        counter.inc(scope='second')
+        self.assertEqual(list(samples), [])
+
+        histogram.observe(.1, scope='first')
+        samples = histogram.samples()
+        next(samples)
+        histogram.observe(.1, scope='first')
+        histogram.observe(.1, scope='second')
+        rest = list(samples)
+        self.assertEqual({key[0] for _, key, _ in rest}, {('scope', 'first')})
+        # The buckets and count of one scrape agree
+        self.assertIn(('scrape_test_seconds_count', (('scope', 'first'),), 1), rest)
+
+class ThrottleTestCase(APITestCase):
+    def setUp(self):
+        bucket_store.clear()
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.now = 1000.0
+        timer = patch.object(TokenBucketThrottle, 'timer', staticmethod(lambda: self.now))
+        timer.start()
+        self.addCleanup(timer.stop)
+
+    def get_auth_token(self, username='test_username', password='wrong', **extra):
+        return self.client.post(
+            '/get_auth_token/',
+            json.dumps({'username': username, 'password': password}),
+            content_type='application/json', **extra
+        )
+
+    def test_username_bucket(self):
+        '''Ensure attempts beyond the bucket are rejected before checking the password'''
+        for _ in range(10):
+            self.assertEqual(self.get_auth_token().status_code, status.HTTP_400_BAD_REQUEST)
+        checks = hash_seconds.get(operation='check')
+        rejections = throttled.get(scope='credentials_username')
+        # Other IPs and cases of the username share the bucket
+        response = self.get_auth_token('TEST_username', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '6')
+        self.assertEqual(hash_seconds.get(operation='check'), checks)
+        self.assertEqual(throttled.get(scope='credentials_username'), rejections + 1)
+        with self.settings(METRICS_TOKEN='scraper-token'):
+            metrics = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scraper-token').content
+        self.assertIn(b'throttled_requests_total{scope="credentials_username"}', metrics)
+
+        # One attempt every 6 seconds
+        self.now += 6
+        self.assertEqual(self.get_auth_token(password='test123').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_auth_token(password='test123').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_ip_bucket(self):
+        '''Ensure attempts from one IP share a bucket, whichever username they target'''
+        rates = {'credentials_ip': '3/min', 'credentials_username': '10/min'}
+        with self.settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates)):
+            for i in range(3):
+                self.assertEqual(self.get_auth_token('user_{}'.format(i)).status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(self.get_auth_token('user_4').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(self.get_auth_token('user_4', REMOTE_ADDR='10.0.0.2').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_forwarded_for_is_not_trusted(self):
+        '''Ensure rotating X-Forwarded-For doesn't get a fresh IP bucket'''
+        rates = {'credentials_ip': '3/min', 'credentials_username': '10/min'}
+        for num_proxies in (None, 0):
+            bucket_store.clear()
+            with self.settings(REST_FRAMEWORK=dict(
+                settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates, NUM_PROXIES=num_proxies
+            )):
+                for i in range(3):
+                    response = self.get_auth_token('user_{}'.format(i), HTTP_X_FORWARDED_FOR='10.0.1.{}'.format(i))
+                    self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                response = self.get_auth_token('user_4', HTTP_X_FORWARDED_FOR='10.0.1.4')
+                self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS, num_proxies)
+
+    def test_change_password_is_throttled(self):
+        '''Ensure change_password takes from the authenticated user's bucket'''
+        self.client.force_authenticate(user=self.user)
+        url = '/users/{}/change_password/'.format(self.user.id)
+        for _ in range(10):
+            response = self.client.post(url, json.dumps({'password': 'picapau@#'}), content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(url, json.dumps({'password': 'picapau@#'}), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        # Other actions aren't throttled
+        self.assertEqual(self.client.get('/users/{}/'.format(self.user.id)).status_code, status.HTTP_200_OK)
+
+class BreachedPasswordTestCase(APITestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.source = os.path.join(directory.name, 'breached.txt')
+        self.index = os.path.join(directory.name, 'breached.idx')
+
+    def build(self, lines, *args):
+        with open(self.source, 'w') as source:
+            source.write('\n'.join(lines) + '\n')
+        call_command('build_password_index', self.source, '--output', self.index, stdout=StringIO(), *args)
+        return BreachedPasswordValidator(self.index)
+
+    def test_breached_passwords_are_rejected(self):
+        '''Ensure listed passwords are rejected, across sorted runs and duplicates'''
+        breached = ['password{}'.format(i) for i in range(50)]
+        validator = self.build(breached + breached[:10], '--chunk-size', '7')
+        self.assertEqual(len(open_index(self.index)), 50)
+        for password in breached:
+            with self.assertRaises(ValidationError):
+                validator.validate(password)
+        validator.validate('picapau@#')
+        validator.validate('Password1')
+
+    def test_sha1_lists(self):
+        '''Ensure the index can be built from Pwned Passwords style SHA-1 lines'''
+        line = '{}:42'.format(hashlib.sha1(b'picapau@#').hexdigest().upper())
+        validator = self.build([line], '--sha1')
+        with self.assertRaises(ValidationError):
+            validator.validate('picapau@#')
+
+    def test_missing_index_accepts_passwords(self):
+        '''Ensure passwords are accepted until the index is built, and checked once it is'''
+        validator = BreachedPasswordValidator(self.index)
+        validator.validate('picapau@#')
+        self.build(['picapau@#'])
+        with self.assertRaises(ValidationError):
+            validator.validate('picapau@#')
+
+        # Rebuilt indexes replace the one already opened
+        self.build(['password1'])
+        validator.validate('picapau@#')
+        with self.assertRaises(ValidationError):
+            validator.validate('password1')
+
+    def test_unreadable_index_accepts_passwords(self):
+        '''Ensure an index the app can't read is logged and skipped rather than failing validation'''
+        validator = self.build(['picapau@#'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.index).st_mode), 0o644)
+        os.chmod(self.index, 0o600)
+        with patch('accounts.password_index.PasswordIndex', side_effect=PermissionError(13, 'Permission denied')):
+            with self.assertLogs('accounts.password_index', 'ERROR'):
+                validator.validate('picapau@#')
+
+class ReplayTestCase(APITestCase):
+    def setUp(self):
+        bucket_store.clear()
+        user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        token = Token.objects.create(user=user)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = os.path.join(directory.name, 'requests.jsonl')
+        self.output = os.path.join(directory.name, 'results.json')
+        entries = [
+            {'path': '/users/{}/'.format(user.id), 'headers': {'Authorization': 'Token {}'.format(token.key)}},
+        ] * 5 + [
+            {'method': 'POST', 'path': '/get_auth_token/', 'body': {'username': 'test_username', 'password': 'test123'}},
+        ]
+        with open(self.log, 'w') as log:
+            log.write('\n'.join(json.dumps(entry) for entry in entries))
+
+    def replay(self, *args):
+        # The test runner's database holds the users of the log
+        call_command('replay', self.log, '--output', self.output, '--live-database', stdout=StringIO(), *args)
+        with open(self.output) as output:
+            return json.load(output)
+
+    def test_results_per_route(self):
+        '''Ensure requests are grouped by route with their latency and queries'''
+        results = self.replay()
+        self.assertEqual(results['requests'], 6)
+        detail = results['routes']['user-detail']
+        self.assertEqual(detail['requests'], 5)
+        self.assertEqual(detail['statuses'], {'200': 5})
+        self.assertLessEqual(detail['p50_ms'], detail['p99_ms'])
+        self.assertEqual(results['routes']['get_auth_token']['statuses'], {'200': 1})
+        self.assertGreater(results['routes']['get_auth_token']['queries_per_request'], 0)
+
+    def test_regressions_fail(self):
+        '''Ensure a run slower than its baseline fails'''
+        results = self.replay()
+        for stats in results['routes'].values():
+            stats['p95_ms'] = 0
+        baseline = self.output + '.baseline'
+        with open(baseline, 'w') as output:
+            json.dump(results, output)
+        with self.assertRaises(CommandError):
+            self.replay('--baseline', baseline)
+
+    def test_throwaway_database_by_default(self):
+        '''Ensure recorded writes only reach the configured database with --live-database'''
+        with patch('accounts.management.commands.replay.test_database') as test_database:
+            call_command('replay', self.log, stdout=StringIO())
+        test_database.assert_called_once_with()
+        with patch('accounts.management.commands.replay.test_database') as test_database:
+            self.replay()
+        test_database.assert_not_called()
+
+class ConditionalRequestsTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.client.force_authenticate(user=self.user)
+        self.url = '/users/{}/'.format(self.user.id)
+
+    def patch(self, data, **extra):
+        return self.client.patch(self.url, json.dumps(data), content_type='application/json', **extra)
+
+    def test_unchanged_user_is_not_sent_again(self):
+        '''Ensure a matching If-None-Match gets a 304 without serializing the user'''
+        etag = self.client.get(self.url)['ETag']
+        with patch.object(UserSerializer, 'to_representation') as to_representation:
+            # The user's row is still read, for its version
+            with self.assertNumQueries(1):
+                response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        to_representation.assert_not_called()
+
+    def test_saving_changes_the_etag(self):
+        '''Ensure every save bumps the version the ETag is built from'''
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.patch({'email': 'new@username.com'})['ETag'], self.client.get(self.url)['ETag'])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content.decode())['email'], 'new@username.com')
+
+        # Partial saves, as done on login, bump it too
+        etag = response['ETag']
+        User.objects.get(pk=self.user.pk).save(update_fields=['last_login'])
+        self.user.refresh_from_db()
+        self.assertNotEqual(self.client.get(self.url)['ETag'], etag)
+
+    def test_update_requires_a_fresh_etag(self):
+        '''Ensure an update with a stale If-Match is refused'''
+        etag = self.client.get(self.url)['ETag']
+        response = self.patch({'email': 'new@username.com'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.patch({'email': 'other@username.com'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(User.objects.get(pk=self.user.pk).email, 'new@username.com')
+
+    def test_concurrent_saves_conflict(self):
+        '''Ensure two instances of a row saved one after the other don't both get written'''
+        first, second = User.objects.get(pk=self.user.pk), User.objects.get(pk=self.user.pk)
+        first.email = 'first@username.com'
+        first.save()
+        second.email = 'second@username.com'
+        with self.assertRaises(VersionConflict):
+            second.save()
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual((user.email, user.version), ('first@username.com', first.version))
+
+    def test_concurrent_update_is_refused(self):
+        '''Ensure a write landing between the If-Match check and the save gets a 412'''
+        etag = self.client.get(self.url)['ETag']
+        perform_update = UserViewSet.perform_update
+
+        def perform_update_racing(view, serializer):
+            # Another request saves the user once this one checked If-Match
+            concurrent = User.objects.get(pk=self.user.pk)
+            concurrent.first_name = 'Concurrent'
+            concurrent.save()
+            perform_update(view, serializer)
+
+        with patch.object(UserViewSet, 'perform_update', perform_update_racing):
+            response = self.patch({'email': 'new@username.com'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual((user.email, user.first_name), ('test@username.com', 'Concurrent'))
+
+class RepresentationCacheTestCase(APITestCase):
+    def setUp(self):
+        representation_cache.clear()
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.client.force_authenticate(user=self.user)
+        self.url = '/users/{}/'.format(self.user.id)
+
+    def test_retrieve_is_cached(self):
+        '''Ensure a user is serialized once for as long as it isn't modified'''
+        first = self.client.get(self.url)
+        with patch.object(UserSerializer, 'to_representation') as to_representation:
+            second = self.client.get(self.url)
+        to_representation.assert_not_called()
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_saves_invalidate_the_cache(self):
+        '''Ensure updates and password changes are never served stale'''
+        self.client.get(self.url)
+        self.client.patch(self.url, json.dumps({'email': 'new@username.com'}), content_type='application/json')
+        response = self.client.get(self.url)
+        self.assertEqual(json.loads(response.content.decode())['email'], 'new@username.com')
+
+        fieldset = self.client.get(self.url + '?fields=email')
+        Token.objects.create(user=self.user)
+        self.client.post(
+            self.url + 'change_password/', json.dumps({'password': 'picapau@#'}), content_type='application/json'
+        )
+        self.assertNotEqual(self.client.get(self.url + '?fields=email')['ETag'], fieldset['ETag'])
+        self.client.patch(self.url, json.dumps({'email': 'other@username.com'}), content_type='application/json')
+        response = self.client.get(self.url + '?fields=email')
+        self.assertEqual(json.loads(response.content.decode()), {'email': 'other@username.com'})
+        # Entries are keyed by version, none is left for the current one
+        user = User.objects.get(pk=self.user.pk)
+        self.assertIsNone(representation_cache.get('{}:{}'.format(user.pk, user.version)))
+
+    def test_other_renderers_skip_the_cache(self):
+        '''Ensure the browsable API still renders its own page'''
+        self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('text/html', response['Content-Type'])
+
+class ProfilingTestCase(APITestCase):
+    def setUp(self):
+        bucket_store.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.user = User.objects.create_user('test_username', 'test@username.com', 'test123')
+        self.client.force_authenticate(user=self.user)
+
+    def profiling(self, **options):
+        return self.settings(REQUEST_PROFILING=dict(settings.REQUEST_PROFILING, DIRECTORY=self.directory, **options))
+
+    def change_password(self, **extra):
+        response = self.client.post(
+            '/users/{}/change_password/'.format(self.user.id),
+            json.dumps({'password': 'picapau@#'}),
+            content_type='application/json', **extra
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_requested_profiles(self):
+        '''Ensure requests with a signed header are profiled and tagged with their action'''
+        with self.profiling():
+            response = self.change_password(HTTP_X_PROFILE=profile_token('prof'))
+            self.assertNotIn('X-Profile-Id', self.change_password(HTTP_X_PROFILE='prof'))
+            self.assertNotIn('X-Profile-Id', self.change_password())
+        self.assertEqual(os.listdir(self.directory), [response['X-Profile-Id']])
+        self.assertTrue(response['X-Profile-Id'].endswith('_UserViewSet.change_password.prof'))
+
+        out = StringIO()
+        call_command('profile_report', directory=self.directory, sort='cumtime', limit=100, stdout=out)
+        self.assertIn('UserViewSet.change_password (1 prof profiles)', out.getvalue())
+        self.assertIn('views.py', out.getvalue())
+        self.assertIn('(change_password)', out.getvalue())
+
+    def test_unsaved_profiles_leave_the_response_alone(self):
+        '''Ensure a profile that can't be written is logged, not turned into a 500'''
+        # A file where the directory should be
+        blocked = os.path.join(self.directory, 'blocked')
+        open(blocked, 'w').close()
+        with self.settings(REQUEST_PROFILING=dict(settings.REQUEST_PROFILING, DIRECTORY=blocked, SAMPLE_RATE=1)):
+            with self.assertLogs('utils.middleware', 'ERROR'):
+                response = self.change_password(HTTP_X_PROFILE=profile_token('prof'))
+        self.assertNotIn('X-Profile-Id', response)
+
+    def test_sampled_profiles(self):
+        '''Ensure sampled requests are written as collapsed stacks, keeping the newest'''
+        with self.profiling(SAMPLE_RATE=1, FORMAT='collapsed', MAX_FILES=2):
+            for _ in range(3):
+                self.change_password()
+            self.client.get('/users/{}/'.format(self.user.id))
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].endswith('_UserViewSet.change_password.collapsed'))
+        self.assertTrue(names[1].endswith('_UserViewSet.retrieve.collapsed'))
+
+        out = StringIO()
+        call_command('profile_report', directory=self.directory, view='UserViewSet.change', stdout=out)
+        self.assertIn('UserViewSet.change_password (1 collapsed profiles)', out.getvalue())
+        self.assertNotIn('retrieve', out.getvalue())
+
+class SettingsProfileTestCase(SimpleTestCase):
+    def test_api_profile_serves_token_requests(self):
+        '''Ensure the API-only settings boot and serve a token-authenticated request'''
+        manage = os.path.join(settings.BASE_DIR, 'manage.py')
+        environment = dict(os.environ, DJANGO_SETTINGS_MODULE='api.settings_api')
+        subprocess.check_call(
+            [sys.executable, manage, 'benchmark', 'request_overhead', '--count', '1'],
+            env=environment, stdout=subprocess.DEVNULL,
+        )
+
+class SparseFieldsetsTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@admin.com', 'test123')
+        self.client.force_authenticate(user=self.admin)
+        User.objects.bulk_create(
+            User(username='user_{}'.format(i), email='user_{}@user.com'.format(i)) for i in range(5)
+        )
+
+    def test_list_reads_only_requested_columns(self):
+        '''Ensure ?fields= trims the list and the columns it reads'''
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/users/?fields=id,username')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'username'})
+        self.assertNotIn('email', context.captured_queries[0]['sql'])
+
+        response = self.client.get('/users/?fields=email&stream=1')
+        users = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual(users[1], {'email': 'user_0@user.com'})
+
+    def test_retrieve_fields(self):
+        '''Ensure a single user can be retrieved with some of its fields, under an ETag of their own'''
+        user = User.objects.get(username='user_0')
+        sparse = self.client.get('/users/{}/?fields=username,email'.format(user.id))
+        self.assertEqual(json.loads(sparse.content.decode()), {'username': 'user_0', 'email': 'user_0@user.com'})
+        full = self.client.get('/users/{}/'.format(user.id))
+        self.assertEqual(set(json.loads(full.content.decode())), {'id', 'username', 'email'})
+
+        self.assertNotEqual(sparse['ETag'], full['ETag'])
+        response = self.client.get('/users/{}/'.format(user.id), HTTP_IF_NONE_MATCH=sparse['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get('/users/{}/?fields=email,username'.format(user.id), HTTP_IF_NONE_MATCH=sparse['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_unknown_fields_are_rejected(self):
+        '''Ensure write only and unknown fields can't be requested'''
+        response = self.client.get('/users/?fields=id,password,nope')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_values_serializer_matches_serializer(self):
+        '''Ensure the values() fast path renders users like UserSerializer does'''
+        compiled = ValuesSerializer.compile(UserSerializer())
+        queryset = User.objects.order_by('id')
+        self.assertEqual(
+            [compiled.to_representation(row) for row in queryset.values(*compiled.columns)],
+            [dict(user) for user in UserSerializer(queryset, many=True).data]
+        )
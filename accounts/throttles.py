@@ -0,0 +1,156 @@
+'''
+Token bucket throttles for the endpoints checking passwords.
+
+They run before the view, so a rejected attempt costs a
+dict lookup instead of a password hash. Buckets live in this
+process unless THROTTLE_STORE['CACHE_ALIAS'] names one of
+CACHES, which is then used instead so every worker sees
+the same buckets.
+'''
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from rest_framework.exceptions import ParseError
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+from utils.cache import LRUCache
+from utils.metrics import Counter
+
+throttled = Counter('throttled_requests_total', 'Requests rejected by a token bucket throttle.')
+
+class BucketStore(object):
+    '''
+    Maps keys to (tokens, updated) buckets, configured
+    lazily from THROTTLE_STORE: MAX_SIZE buckets are kept
+    locally, or CACHE_ALIAS picks a shared cache.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = None
+        self._shared = None
+
+    def _configure(self):
+        options = getattr(settings, 'THROTTLE_STORE', {})
+        alias = options.get('CACHE_ALIAS')
+        self._shared = caches[alias] if alias else None
+        # A missing bucket is a full one, old buckets can go
+        self._local = LRUCache(options.get('MAX_SIZE', 100000), ttl=24 * 60 * 60)
+
+    def update(self, key, update, timeout):
+        '''
+        Replaces the bucket at key with update(bucket), bucket
+        being None for new keys. Atomic for the local store only,
+        concurrent workers may let a few extra requests through.
+        '''
+        with self._lock:
+            if self._local is None:
+                self._configure()
+            if self._shared is None:
+                bucket = update(self._local.get(key))
+                self._local.set(key, bucket)
+                return bucket
+        bucket = update(self._shared.get(key))
+        self._shared.set(key, bucket, timeout)
+        return bucket
+
+    def clear(self):
+        with self._lock:
+            self._local = None
+
+bucket_store = BucketStore()
+
+@receiver(setting_changed)
+def reset_bucket_store(setting, **kwargs):
+    if setting == 'THROTTLE_STORE':
+        bucket_store.clear()
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    '''
+    Rates ('5/min') from DEFAULT_THROTTLE_RATES[scope] set the
+    bucket's capacity, the bucket refilling at that pace. Unlike
+    SimpleRateThrottle, no history of requests is kept.
+    '''
+    store = bucket_store
+    timer = time.monotonic
+
+    @property
+    def THROTTLE_RATES(self):
+        # Read when used so the rates follow REST_FRAMEWORK changes
+        return api_settings.DEFAULT_THROTTLE_RATES
+
+    def get_ident_key(self, request, view):
+        raise NotImplementedError('.get_ident_key() must be overridden')
+
+    def get_cache_key(self, request, view):
+        ident = self.get_ident_key(request, view)
+        if ident is None:
+            return None
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+
+        now = self.timer()
+        refill = self.num_requests / self.duration
+        taken = []
+
+        def take(bucket):
+            tokens, updated = bucket or (self.num_requests, now)
+            tokens = min(self.num_requests, tokens + (now - updated) * refill)
+            if tokens >= 1:
+                tokens -= 1
+                taken.append(True)
+            return tokens, now
+
+        tokens, _ = self.store.update(key, take, self.duration)
+        if taken:
+            return True
+        self.wait_seconds = (1 - tokens) / refill
+        throttled.inc(scope=self.scope)
+        return False
+
+    def wait(self):
+        return self.wait_seconds
+
+class IPThrottle(TokenBucketThrottle):
+    '''
+    Per client IP. Behind proxies, NUM_PROXIES picks the address
+    they append to X-Forwarded-For. Unset, DRF's get_ident() would
+    use the whole header, which clients can rotate for fresh buckets,
+    so REMOTE_ADDR is used instead.
+    '''
+    scope = 'credentials_ip'
+
+    def get_ident_key(self, request, view):
+        if api_settings.NUM_PROXIES is None:
+            return request.META.get('REMOTE_ADDR')
+        return self.get_ident(request)
+
+class UsernameThrottle(TokenBucketThrottle):
+    '''
+    Per targeted account, whichever IP the attempts come from:
+    the username being logged in as, or the authenticated user
+    '''
+    scope = 'credentials_username'
+
+    def get_ident_key(self, request, view):
+        try:
+            username = request.data.get('username')
+        except (AttributeError, ParseError):
+            # Not a dict, or malformed, the view rejects it
+            username = None
+        if not username and request.user and request.user.is_authenticated:
+            username = request.user.get_username()
+        if not isinstance(username, str) or not username:
+            return None
+        return username.lower()
@@ -0,0 +1,52 @@
+'''
+Stateless signed tokens, "<user id>:<expiry>:<generation>:<signature>".
+
+The signature is an HMAC of the rest of the token keyed on SECRET_KEY,
+so tokens are checked without a token table. The generation is the
+user's credential_generation when the token was issued, bumping it
+revokes every token issued before.
+'''
+import time
+
+from django.conf import settings
+from django.core import signing
+
+SALT = 'accounts.signed-token'
+
+def get_options():
+    return getattr(settings, 'SIGNED_TOKENS', {})
+
+def signed_tokens_enabled():
+    return get_options().get('ENABLED', False)
+
+def legacy_tokens_enabled():
+    '''
+    Whether rest_framework.authtoken tokens are still issued,
+    and rotated by change_password, while clients migrate
+    '''
+    return get_options().get('LEGACY_TOKENS', True)
+
+def is_signed_token(key):
+    # authtoken keys are hex
+    return ':' in key
+
+def make_signed_token(user):
+    expires = int(time.time()) + get_options().get('MAX_AGE', 24 * 60 * 60)
+    value = '{}:{}:{}'.format(user.pk, expires, user.credential_generation)
+    return signing.Signer(salt=SALT).sign(value)
+
+def read_signed_token(token):
+    '''
+    The (user pk, generation) a token was issued for.
+    Raises signing.BadSignature if it was tampered
+    with or signing.SignatureExpired if it expired.
+    '''
+    try:
+        value = signing.Signer(salt=SALT).unsign(token)
+        user_pk, expires, generation = value.split(':')
+        expires, generation = int(expires), int(generation)
+    except ValueError:
+        raise signing.BadSignature('Malformed token.')
+    if expires < time.time():
+        raise signing.SignatureExpired('Token expired.')
+    return user_pk, generation
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils.translation import gettext as _
+
+from .password_index import open_index, password_digest
+
+class BreachedPasswordValidator(object):
+    '''
+    Validate whether the password appears in the breached
+    passwords index built by the build_password_index command.
+    Passwords are accepted while the index hasn't been built.
+    '''
+    def __init__(self, index_path=None):
+        self.index_path = index_path or settings.BREACHED_PASSWORDS_INDEX
+
+    def validate(self, password, user=None):
+        index = open_index(self.index_path)
+        if index is not None and password_digest(password) in index:
+            raise ValidationError(
+                _('This password has appeared in a data breach.'),
+                code='password_breached',
+            )
+
+    def get_help_text(self):
+        return _("Your password can't be one that has appeared in a data breach.")
@@ -1,50 +1,199 @@
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.http import StreamingHttpResponse
 
 from rest_framework import viewsets, status
 from rest_framework.permissions import IsAdminUser
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.exceptions import APIException, ParseError, ValidationError
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
+from rest_framework.authtoken.views import ObtainAuthToken as BaseObtainAuthToken
 
-from utils.mixins import MixedPermissionsMixin
+from utils.filters import IndexedFilterBackend, IndexedSearchFilter
+from utils.mixins import (
+    CachedRepresentationMixin, ConditionalMixin, MixedPermissionsMixin,
+    MixedThrottlesMixin, SparseFieldsetsMixin, StreamingListMixin, ValuesListMixin,
+)
+from utils.parsers import NDJSONParser
+from utils.streaming import keyset_batches, stream_csv, stream_ndjson
 
+from .bulk import provision_users
+from .caches import representation_cache
+from .hashing import HashingUnavailable
 from .serializers import UserSerializer, PasswordSerializer
+from .throttles import IPThrottle, UsernameThrottle
+from .tokens import legacy_tokens_enabled
+from .pagination import UserCursorPagination
 from .permissions import IsSelf, IsAdminOrSelf
 
 User = get_user_model()
 
-class UserViewSet(MixedPermissionsMixin, viewsets.ModelViewSet):
+class ServiceUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many password operations in progress, try again later.'
+    default_code = 'hashing_unavailable'
+
+    def __init__(self, wait):
+        super(ServiceUnavailable, self).__init__()
+        # Sent as Retry-After by the exception handler
+        self.wait = wait
+
+class HashingUnavailableMixin(object):
+    '''
+    Answers HashingUnavailable, raised by User.set_password and
+    check_password when the hashing queue is full, with a 503
+    '''
+    def handle_exception(self, exc):
+        if isinstance(exc, HashingUnavailable):
+            exc = ServiceUnavailable(exc.wait)
+        return super(HashingUnavailableMixin, self).handle_exception(exc)
+
+class UserViewSet(HashingUnavailableMixin, MixedPermissionsMixin, MixedThrottlesMixin, SparseFieldsetsMixin,
+                  StreamingListMixin, ValuesListMixin, CachedRepresentationMixin, ConditionalMixin,
+                  viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    pagination_class = UserCursorPagination
+    representation_cache = representation_cache
+    filter_backends = (IndexedFilterBackend, IndexedSearchFilter)
+    '''
+    Every lookup is backed by an index, see
+    the 0003_user_search_indexes migration
+    '''
+    indexed_filter_fields = {
+        'username': ('exact', 'startswith', 'iexact', 'istartswith'),
+        'email': ('exact', 'startswith', 'iexact', 'istartswith'),
+    }
+    indexed_search_fields = {
+        'username': 'istartswith',
+        'email': 'iexact',
+    }
     permission_classes_by_action = {
         'list': [IsAdminUser],
+        'bulk_create': [IsAdminUser],
+        'export': [IsAdminUser],
         'retrieve': [IsAdminOrSelf],
         'update': [IsAdminOrSelf],
+        'partial_update': [IsAdminOrSelf],
         'destroy': [IsAdminOrSelf],
         'change_password': [IsSelf],
     }
+    throttle_classes_by_action = {
+        'change_password': [IPThrottle, UsernameThrottle],
+    }
+    '''
+    Queries made by each action, authentication aside, when
+    an admin acts on another user (see QueryBudgetMiddleware)
+    '''
+    query_budget_by_action = {
+        'list': 1,
+        'create': 3,
+        'retrieve': 1,
+        'update': 4,
+        'partial_update': 3,
+        'destroy': 7,
+        'change_password': 8,
+    }
+    export_fields = (
+        'id', 'username', 'email', 'first_name', 'last_name',
+        'is_staff', 'is_active', 'date_joined', 'last_login',
+    )
+    export_batch_size = 1000
 
     '''
-    Override create so we can pass the 
-    generated token to the response
+    Override create so we can pass the
+    generated token to the response.
+    The user and its token are written in one transaction
     '''
     def create(self, request):
-        response = super(UserViewSet, self).create(request)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            user = serializer.save()
+            token = user.set_auth_token()
+        data = serializer.data
+        headers = self.get_success_headers(data)
         # Add new user's token to the response
-        instance = User.objects.get(pk=response.data.get('id'))
-        response.data.update(instance.set_auth_token())
-        return response
+        data.update(token)
+        return Response(data, status=status.HTTP_201_CREATED, headers=headers)
 
+    '''
+    The user is read from its row rather than taken from
+    request.user, which may be a cached snapshot, and only
+    the fields changed here are written back
+    '''
     @detail_route(methods=['post'])
     def change_password(self, request, pk=None):
         user = self.get_object()
         serializer = PasswordSerializer(data=request.data)
         if serializer.is_valid():
-            user.set_password(serializer.data['password'])
-            user.save()
-            # Delete the existing token
-            Token.objects.get(user=user).delete()
-            # Returns a newly created token within the response
-            return Response(user.set_auth_token(), status=status.HTTP_200_OK)
+            with transaction.atomic():
+                user.set_password(serializer.data['password'])
+                # Revoke the existing tokens
+                user.revoke_auth_tokens()
+                user.save(update_fields=['password'])
+                # Returns newly created tokens within the response
+                tokens = user.set_auth_token()
+            return Response(tokens, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    '''
+    Creates many users from a JSON array or an NDJSON stream.
+    Rows are validated and reported on independently,
+    the valid ones are created even if others fail.
+    '''
+    @list_route(methods=['post'], url_path='bulk', parser_classes=[JSONParser, NDJSONParser])
+    def bulk_create(self, request):
+        if not isinstance(request.data, list):
+            raise ParseError('Expected a list of users.')
+        created, errors = provision_users(request.data)
+        if not errors:
+            response_status = status.HTTP_201_CREATED
+        elif created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({'created': created, 'errors': errors}, status=response_status)
+
+    '''
+    Streams every user as NDJSON, or CSV with ?type=csv,
+    ordered by id. ?after=<id> resumes an interrupted export.
+    Rows are read in batches straight from values_list,
+    without going through UserSerializer.
+    '''
+    @list_route(methods=['get'])
+    def export(self, request):
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in ('ndjson', 'csv'):
+            raise ValidationError({'type': ['Must be either ndjson or csv.']})
+        after = request.query_params.get('after')
+        if after is not None and not after.isdigit():
+            raise ValidationError({'after': ['Must be an user id.']})
+
+        batches = keyset_batches(self.get_queryset(), self.export_fields, self.export_batch_size, after)
+        if export_type == 'csv':
+            response = StreamingHttpResponse(stream_csv(self.export_fields, batches), content_type='text/csv')
+        else:
+            response = StreamingHttpResponse(stream_ndjson(self.export_fields, batches), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="users.{}"'.format(export_type)
+        return response
+
+class ObtainAuthToken(HashingUnavailableMixin, BaseObtainAuthToken):
+    '''
+    rest_framework's obtain_auth_token, also issuing
+    a signed token when they're enabled (see accounts.tokens),
+    throttled before any password is checked
+    '''
+    throttle_classes = (IPThrottle, UsernameThrottle)
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        user = serializer.validated_data['user']
+        token = Token.objects.get_or_create(user=user)[0] if legacy_tokens_enabled() else None
+        return Response(user.get_auth_tokens(token))
+
+obtain_auth_token = ObtainAuthToken.as_view()
@@ -0,0 +1,16 @@
+"""
+ASGI config for api project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+The views still run synchronously, see utils.asgi.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+from utils.asgi import WSGIToASGI
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
+
+application = WSGIToASGI(get_wsgi_application())
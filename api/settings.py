@@ -41,15 +41,38 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'utils.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'accounts.middleware.HashingUnavailableMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'utils.middleware.QueryBudgetMiddleware',
 ]
 
+# Requests profiled by ProfilingMiddleware: those sending HEADER set to
+# utils.profiling.profile_token('prof' or 'collapsed'), and a SAMPLE_RATE
+# fraction of all requests, in FORMAT. The newest MAX_FILES profiles
+# are kept in DIRECTORY, see manage.py profile_report.
+
+REQUEST_PROFILING = {
+    'HEADER': 'X-Profile',
+    'HEADER_MAX_AGE': 60 * 60,
+    'SAMPLE_RATE': 0,
+    'FORMAT': 'collapsed',
+    'SAMPLE_INTERVAL': .001,
+    'DIRECTORY': os.path.join(BASE_DIR, 'profiles'),
+    'MAX_FILES': 500,
+}
+
+# Queries allowed over a view's query_budget_by_action before
+# QueryBudgetMiddleware logs the request, 1 covers a token cache miss
+
+QUERY_BUDGET_SLACK = 1
+
 ROOT_URLCONF = 'api.urls'
 
 TEMPLATES = [
@@ -75,17 +98,126 @@ AUTH_USER_MODEL = 'accounts.User'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
-    ]
+        # Before CachedTokenAuthentication, which rejects signed tokens
+        'accounts.authentication.SignedTokenAuthentication',
+        'accounts.authentication.CachedTokenAuthentication',
+    ],
+    # Token buckets of accounts.throttles, guarding password checks
+    'DEFAULT_THROTTLE_RATES': {
+        'credentials_ip': '60/min',
+        'credentials_username': '10/min',
+    },
+    # Proxies in front of the app, each appending to X-Forwarded-For.
+    # 0 throttles on REMOTE_ADDR, ignoring the client-supplied header.
+    'NUM_PROXIES': 0,
+}
+
+# Buckets of accounts.throttles, kept in each process
+# unless CACHE_ALIAS names a cache shared by the workers
+
+THROTTLE_STORE = {
+    'MAX_SIZE': 100000,
+    'CACHE_ALIAS': None,
+}
+
+# Stateless tokens from accounts.tokens, issued along with the
+# authtoken ones until LEGACY_TOKENS is turned off.
+# MAX_SIZE, TTL and CACHE_ALIAS configure the cache of their users.
+# Each worker keeps its own, so a password change can take TTL seconds
+# to revoke them in the other workers. Setting CACHE_ALIAS keeps the
+# users there only, evicted for every worker at once.
+
+SIGNED_TOKENS = {
+    'ENABLED': True,
+    'LEGACY_TOKENS': True,
+    'MAX_AGE': 24 * 60 * 60,
+    'MAX_SIZE': 10000,
+    'TTL': 60,
+    'CACHE_ALIAS': None,
+}
+
+# Token key => user cache used by CachedTokenAuthentication.
+# Each worker keeps its own entries, so a token deleted by change_password
+# is still accepted by the other workers for up to TTL seconds. Setting
+# CACHE_ALIAS to one of CACHES keeps the entries there only, shared by
+# the workers, so deleted tokens are rejected everywhere right away.
+
+TOKEN_AUTH_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 60,
+    'CACHE_ALIAS': None,
+}
+
+# Threads running the views under api.asgi, and the response
+# chunks each request can produce ahead of its client
+
+ASGI_WORKERS = {
+    'THREADS': 32,
+    'BUFFERED_CHUNKS': 8,
 }
 
+# POST /batch/, see utils.batch. WORKERS threads
+# serve the sub-requests of ?parallel=1 batches.
+
+BATCH_REQUESTS = {
+    'MAX_REQUESTS': 20,
+    'WORKERS': 4,
+}
+
+# Rendered JSON of retrieved users, see CachedRepresentationMixin
+
+USER_REPRESENTATION_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 300,
+    'CACHE_ALIAS': None,
+}
+
+# Executor running User.set_password/check_password (see accounts.hashing).
+# Operations beyond MAX_QUEUE in flight get a 503 with Retry-After: RETRY_AFTER.
+# Bulk batches smaller than MIN_BATCH are hashed inline, larger ones
+# in chunks of BULK_CHUNK_SIZE, each counting against MAX_QUEUE.
+# Workers start through START_METHOD, forkserver or spawn, as forking
+# the threaded server could deadlock them.
+
+PASSWORD_HASHING = {
+    'EXECUTOR': 'accounts.hashing.ProcessPoolHashingExecutor',
+    'WORKERS': os.cpu_count() or 1,
+    'MAX_QUEUE': 64,
+    'RETRY_AFTER': 1,
+    'MIN_BATCH': 8,
+    'BULK_CHUNK_SIZE': 8,
+    'START_METHOD': 'forkserver',
+}
+
+# /metrics/ is served to staff users and to scrapers
+# sending "Authorization: Bearer <METRICS_TOKEN>"
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
+# utils.db.sqlite3 sets the pragmas on connect and checks the persistent
+# connections. busy_timeout bounds the wait for another writer's lock,
+# statements still waiting after 5s fail with "database is locked".
+# WAL lets readers run alongside the writer, NORMAL syncs on checkpoints
+# only, mmap_size and cache_size (negative for KiB) keep hot pages in memory.
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'utils.db.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {
+            'pragmas': {
+                'journal_mode': 'wal',
+                'synchronous': 'normal',
+                'mmap_size': 256 * 1024 * 1024,
+                'cache_size': -64 * 1024,
+                'busy_timeout': 5000,
+            },
+            'health_checks': True,
+        },
     }
 }
 
@@ -105,8 +237,15 @@ AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator',
     },
+    {
+        'NAME': 'accounts.validators.BreachedPasswordValidator',
+    },
 ]
 
+# Built with ./manage.py build_password_index
+
+BREACHED_PASSWORDS_INDEX = os.path.join(BASE_DIR, 'breached_passwords.idx')
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/2.0/topics/i18n/
@@ -0,0 +1,49 @@
+"""
+Settings for API-only workers.
+
+API clients authenticate with tokens and speak JSON, so these
+workers skip the session, CSRF, messages and clickjacking
+middleware, the apps behind them and the browsable API.
+The admin is served by workers running api.settings.
+
+Run with DJANGO_SETTINGS_MODULE=api.settings_api.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import REST_FRAMEWORK, os
+
+DEBUG = False
+
+ALLOWED_HOSTS = [host for host in os.environ.get('API_ALLOWED_HOSTS', '').split(',') if host]
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'accounts',
+    'rest_framework',
+    'rest_framework.authtoken',
+]
+
+MIDDLEWARE = [
+    'utils.middleware.ProfilingMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'utils.middleware.QueryBudgetMiddleware',
+]
+
+# Error pages fall back to Django's built-in ones
+TEMPLATES = []
+
+REST_FRAMEWORK = dict(
+    REST_FRAMEWORK,
+    DEFAULT_AUTHENTICATION_CLASSES=[
+        'accounts.authentication.SignedTokenAuthentication',
+        'accounts.authentication.CachedTokenAuthentication',
+    ],
+    DEFAULT_RENDERER_CLASSES=[
+        'rest_framework.renderers.JSONRenderer',
+    ],
+    DEFAULT_PARSER_CLASSES=[
+        'rest_framework.parsers.JSONParser',
+    ],
+)
@@ -1,10 +1,13 @@
+from django.apps import apps
 from django.conf.urls import url, include
 from django.contrib import admin
 
 from rest_framework.routers import DefaultRouter
-from rest_framework.authtoken.views import obtain_auth_token
 
 from accounts.routes import routes as accounts_routes
+from accounts.views import obtain_auth_token
+from utils.batch import BatchView
+from utils.views import metrics
 
 router = DefaultRouter()
 
@@ -38,8 +41,17 @@ for route in routes:
     router.register(route[0], route[1])
 
 urlpatterns = [
-    url(r'^admin/', admin.site.urls),
     url(r'^', include(router.urls)),
-    url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^get_auth_token/$', obtain_auth_token, name='get_auth_token'),
+    url(r'^metrics/$', metrics, name='metrics'),
+    url(r'^batch/$', BatchView.as_view(), name='batch'),
 ]
+
+'''
+The admin and the browsable API's login are left
+out of API-only workers (see api.settings_api)
+'''
+if apps.is_installed('django.contrib.admin'):
+    urlpatterns.append(url(r'^admin/', admin.site.urls))
+if apps.is_installed('django.contrib.sessions'):
+    urlpatterns.append(url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')))
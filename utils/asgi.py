@@ -0,0 +1,159 @@
+'''
+Serves a WSGI application over ASGI.
+
+Django 2.0 and rest_framework 3.7 have no async views, so every
+request still runs synchronously, on a bounded pool of threads.
+The event loop does the network I/O, reading request bodies and
+writing responses, so slow clients hold a connection rather
+than a thread, and a process can keep many more requests in
+flight than it has threads. Password hashing stays on the
+process pool of accounts.hashing.
+'''
+import asyncio
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+_DONE = object()
+
+class ClientDisconnected(Exception):
+    pass
+
+def build_environ(scope, body):
+    '''
+    The WSGI environ of an ASGI HTTP scope,
+    body being a file holding the request body
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI strings are bytes decoded as latin-1
+        'PATH_INFO': scope['path'].encode('utf-8').decode('iso-8859-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('iso-8859-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name
+        if key in environ:
+            # Repeated headers are joined, as HTTP/1.1 servers do
+            value = '{},{}'.format(environ[key], value)
+        environ[key] = value
+    return environ
+
+class WSGIToASGI(object):
+    '''
+    ASGI 3 application running wsgi_application on up to
+    ASGI_WORKERS['THREADS'] threads. Responses are sent as they are
+    produced, at most ASGI_WORKERS['BUFFERED_CHUNKS'] chunks ahead
+    of the client, so streamed exports keep a bounded memory.
+    '''
+    def __init__(self, wsgi_application, threads=None, buffered_chunks=None):
+        options = getattr(settings, 'ASGI_WORKERS', {})
+        self.wsgi_application = wsgi_application
+        self.threads = threads or options.get('THREADS', 32)
+        self.buffered_chunks = buffered_chunks or options.get('BUFFERED_CHUNKS', 8)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type {}.'.format(scope['type']))
+
+        body = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        environ = build_environ(scope, body)
+        # Chunked requests have no Content-Length, the body is complete by now
+        environ.setdefault('CONTENT_LENGTH', str(body.tell()))
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        credits = threading.Semaphore(self.buffered_chunks)
+        disconnected = threading.Event()
+        worker = loop.run_in_executor(
+            self.executor, self.run, environ, loop, messages, credits, disconnected
+        )
+        try:
+            while True:
+                message = await messages.get()
+                if message is _DONE:
+                    break
+                await send(message)
+                credits.release()
+        finally:
+            # Stops the worker if the client went away
+            disconnected.set()
+        await worker
+
+    def run(self, environ, loop, messages, credits, disconnected):
+        '''
+        Runs the WSGI application in a worker thread,
+        passing the response messages to the event loop
+        '''
+        def push(message):
+            while not credits.acquire(timeout=.1):
+                if disconnected.is_set():
+                    raise ClientDisconnected()
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers
+            ]
+
+        chunks = None
+        try:
+            chunks = self.wsgi_application(environ, start_response)
+            push({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            for chunk in chunks:
+                if chunk:
+                    push({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            push({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except ClientDisconnected:
+            pass
+        finally:
+            # Sends request_finished, closing this thread's connections
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            environ['wsgi.input'].close()
+            if not disconnected.is_set():
+                loop.call_soon_threadsafe(messages.put_nowait, _DONE)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
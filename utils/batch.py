@@ -0,0 +1,153 @@
+'''
+Runs many API calls in one round-trip, POST /batch/:
+
+    [{"method": "GET", "path": "/users/1/"},
+     {"method": "POST", "path": "/users/1/change_password/",
+      "body": {"password": "..."}, "headers": {"If-Match": "..."}}]
+
+Sub-requests are dispatched in-process to the views of
+the URLconf, authenticated as the batch request itself.
+They skip the middleware, which already ran for the batch,
+but go through the throttles of their views, as the batch's client.
+'''
+import copy
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import unquote_to_bytes, urlsplit
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection
+from django.urls import Resolver404, resolve
+
+from rest_framework import serializers, status
+from rest_framework.parsers import JSONParser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+logger = logging.getLogger(__name__)
+
+# Sent by the batch request itself, credentials aren't passed on
+INHERITED_HEADERS = ('HTTP_HOST', 'HTTP_USER_AGENT', 'HTTP_ACCEPT_LANGUAGE', 'HTTP_X_FORWARDED_FOR')
+# Identify the client, to the throttles among others, so
+# sub-requests can't pose as another one
+CLIENT_HEADERS = (
+    'HTTP_HOST', 'HTTP_FORWARDED', 'HTTP_X_FORWARDED_FOR', 'HTTP_X_FORWARDED_HOST',
+    'HTTP_X_FORWARDED_PROTO', 'HTTP_X_REAL_IP',
+)
+EXCLUDED_HEADERS = ('HTTP_AUTHORIZATION', 'HTTP_COOKIE') + CLIENT_HEADERS
+
+def get_options():
+    return getattr(settings, 'BATCH_REQUESTS', {})
+
+class SubRequestSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(choices=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'], default='GET')
+    path = serializers.RegexField(r'^/')
+    body = serializers.JSONField(required=False)
+    headers = serializers.DictField(child=serializers.CharField(), required=False)
+
+def build_request(request, method, path, body=None, headers=None):
+    '''
+    A WSGIRequest for the sub-request, carrying
+    the batch request's server and client details
+    '''
+    url = urlsplit(path)
+    content = json.dumps(body).encode('utf-8') if body is not None else b''
+    environ = {
+        key: value for key, value in request.META.items()
+        if not key.startswith('HTTP_') or key in INHERITED_HEADERS
+    }
+    for name, value in (headers or {}).items():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in EXCLUDED_HEADERS:
+            environ[key] = value
+    environ.update({
+        'REQUEST_METHOD': method,
+        # WSGI paths are unquoted bytes decoded as latin-1
+        'PATH_INFO': unquote_to_bytes(url.path).decode('iso-8859-1'),
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(content)),
+        'wsgi.input': BytesIO(content),
+    })
+    return WSGIRequest(environ)
+
+def response_body(response):
+    if isinstance(response, Response):
+        # Rendered along with the batch response
+        return response.data
+    if response.streaming:
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+    if not content:
+        return None
+    if response.get('Content-Type', '').startswith('application/json'):
+        return json.loads(content.decode(response.charset))
+    return content.decode(response.charset)
+
+class BatchView(APIView):
+    '''
+    Executes a list of sub-requests, up to BATCH_REQUESTS['MAX_REQUESTS'],
+    and returns their status, headers and body in the same order.
+    With ?parallel=1 they run on up to BATCH_REQUESTS['WORKERS'] threads,
+    for sub-requests that don't depend on each other.
+    '''
+    parser_classes = (JSONParser,)
+    parallel_query_param = 'parallel'
+
+    def post(self, request):
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Expected a list of requests.'}, status=status.HTTP_400_BAD_REQUEST)
+        max_requests = get_options().get('MAX_REQUESTS', 20)
+        if len(request.data) > max_requests:
+            return Response(
+                {'detail': 'A batch can have at most {} requests.'.format(max_requests)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        serializer = SubRequestSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        subrequests = serializer.validated_data
+        workers = min(get_options().get('WORKERS', 4), len(subrequests))
+        if request.query_params.get(self.parallel_query_param) in ('1', 'true') and workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(lambda subrequest: self.execute_closing(request, subrequest), subrequests))
+        else:
+            results = [self.execute(request, subrequest) for subrequest in subrequests]
+        return Response(results)
+
+    def execute(self, request, subrequest):
+        try:
+            match = resolve(urlsplit(subrequest['path']).path)
+        except Resolver404:
+            return {'status': status.HTTP_404_NOT_FOUND, 'headers': {}, 'body': {'detail': 'Not found.'}}
+        if getattr(match.func, 'cls', None) is type(self):
+            return {'status': status.HTTP_400_BAD_REQUEST, 'headers': {}, 'body': {'detail': 'Batches can\'t be nested.'}}
+
+        django_request = build_request(
+            request, subrequest['method'], subrequest['path'],
+            subrequest.get('body'), subrequest.get('headers')
+        )
+        if request.user.is_authenticated:
+            # Reuse the batch's authentication, see rest_framework.request.ForcedAuthentication.
+            # Copied, since views can modify the user and sub-requests may run in threads.
+            django_request._force_auth_user = copy.deepcopy(request.user)
+            django_request._force_auth_token = copy.deepcopy(request.auth)
+        try:
+            response = match.func(django_request, *match.args, **match.kwargs)
+            body = response_body(response)
+        except Exception:
+            logger.exception('Batched %s %s failed', subrequest['method'], subrequest['path'])
+            return {'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'headers': {}, 'body': None}
+        headers = {name: value for name, value in response.items() if name != 'Content-Type'}
+        return {'status': response.status_code, 'headers': headers, 'body': body}
+
+    def execute_closing(self, request, subrequest):
+        try:
+            return self.execute(request, subrequest)
+        finally:
+            # Threads don't go through request_finished
+            connection.close()
@@ -0,0 +1,44 @@
+import time
+from contextlib import contextmanager
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+@contextmanager
+def test_environment():
+    '''
+    Lets the test client reach the views, with DEBUG off
+    as in tests, unless the test runner already did it
+    '''
+    try:
+        setup_test_environment(debug=False)
+    except RuntimeError:
+        yield
+        return
+    try:
+        yield
+    finally:
+        teardown_test_environment()
+
+@contextmanager
+def test_database():
+    '''
+    Runs benchmarks against a throwaway database,
+    created the same way the test runner does
+    '''
+    with test_environment():
+        runner = DiscoverRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        try:
+            yield
+        finally:
+            runner.teardown_databases(old_config)
+
+@contextmanager
+def stopwatch(results, name):
+    '''
+    Stores the elapsed seconds of the block in results[name]
+    '''
+    start = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - start
@@ -0,0 +1,123 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+_MISSING = object()
+
+class LRUCache(object):
+    '''
+    Thread-safe mapping bounded to max_size entries,
+    evicting the least recently used one first.
+    Entries older than ttl seconds are treated as missing.
+    '''
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class ConfiguredCache(object):
+    '''
+    An in-process LRUCache, or one of the CACHES aliases
+    when entries have to be shared between workers, never both.
+
+    Configured lazily from the settings dict named by setting_name:
+    MAX_SIZE and TTL size the local LRU, CACHE_ALIAS (or None)
+    picks the shared backend instead. With a shared backend an
+    entry deleted by one worker is gone for all of them rather
+    than served until its TTL.
+    '''
+    instances = weakref.WeakSet()
+
+    def __init__(self, setting_name, prefix):
+        self.setting_name = setting_name
+        self.prefix = prefix
+        self._configured = False
+        self._local = None
+        self._shared = None
+        self.instances.add(self)
+
+    def _ensure_configured(self):
+        if self._configured:
+            return
+        options = getattr(settings, self.setting_name, {})
+        self.ttl = options.get('TTL', 60)
+        alias = options.get('CACHE_ALIAS')
+        self._shared = caches[alias] if alias else None
+        self._local = None if alias else LRUCache(options.get('MAX_SIZE', 1024), self.ttl)
+        self._configured = True
+
+    def make_key(self, key):
+        return '{}:{}'.format(self.prefix, key)
+
+    def get(self, key, default=None):
+        self._ensure_configured()
+        if self._shared is not None:
+            return self._shared.get(self.make_key(key), default)
+        return self._local.get(key, default)
+
+    def set(self, key, value):
+        self._ensure_configured()
+        if self._shared is not None:
+            self._shared.set(self.make_key(key), value, self.ttl)
+        else:
+            self._local.set(key, value)
+
+    def delete(self, key):
+        self._ensure_configured()
+        if self._shared is not None:
+            self._shared.delete(self.make_key(key))
+        else:
+            self._local.delete(key)
+
+    def clear(self):
+        '''
+        Drops the local entries. Does nothing with a shared
+        backend, which may hold other data, its entries
+        are left to expire or be deleted one by one.
+        '''
+        self._ensure_configured()
+        if self._local is not None:
+            self._local.clear()
+
+@receiver(setting_changed)
+def reconfigure_caches(setting, **kwargs):
+    for cache in list(ConfiguredCache.instances):
+        if cache.setting_name == setting:
+            cache._configured = False
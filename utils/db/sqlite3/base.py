@@ -0,0 +1,75 @@
+'''
+SQLite backend tuned for serving concurrent requests,
+ENGINE 'utils.db.sqlite3'. On top of sqlite3's OPTIONS it takes:
+
+    'pragmas': {'journal_mode': 'wal', 'synchronous': 'normal', ...}
+        set on every new connection, in that order
+    'health_checks': True
+        checks persistent connections (CONN_MAX_AGE) once per
+        request before reusing them
+
+Waiting for another writer's lock is left to SQLite's busy handler,
+set in milliseconds by the busy_timeout pragma or in seconds by
+sqlite3's timeout option, one or the other. A statement
+fails with "database is locked" once it has waited that long. Within
+a transaction that already read, it can fail right away instead, as
+waiting could deadlock with the other writer.
+'''
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3.base import Database, DatabaseWrapper as SQLiteDatabaseWrapper
+
+PRAGMA_NAME = re.compile(r'^[a-z_]+$')
+PRAGMA_VALUE = re.compile(r'^(-?\d+|[A-Za-z_]+)$')
+
+# Options of this backend, the others are sqlite3.connect arguments
+BACKEND_OPTIONS = ('pragmas', 'health_checks')
+
+class DatabaseWrapper(SQLiteDatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        options = self.settings_dict['OPTIONS']
+        self.pragmas = options.get('pragmas', {})
+        for name, value in self.pragmas.items():
+            if not PRAGMA_NAME.match(name) or not PRAGMA_VALUE.match(str(value)):
+                raise ImproperlyConfigured('Invalid SQLite pragma {} = {}.'.format(name, value))
+        if 'busy_timeout' in self.pragmas and 'timeout' in options:
+            raise ImproperlyConfigured('Set either the busy_timeout pragma or the timeout option.')
+        self.health_checks = options.get('health_checks', False)
+        self.health_check_done = False
+
+    def get_connection_params(self):
+        kwargs = super(DatabaseWrapper, self).get_connection_params()
+        for name in BACKEND_OPTIONS:
+            kwargs.pop(name, None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super(DatabaseWrapper, self).get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return conn
+
+    def is_usable(self):
+        try:
+            self.connection.execute('SELECT 1')
+        except Database.Error:
+            return False
+        return True
+
+    def ensure_connection(self):
+        '''
+        Replaces a persistent connection that stopped
+        working, on its first use by every request
+        '''
+        if self.health_checks and self.connection is not None and not self.health_check_done:
+            if not self.in_atomic_block and not self.is_in_memory_db() and not self.is_usable():
+                self.close()
+            self.health_check_done = True
+        super(DatabaseWrapper, self).ensure_connection()
+
+    def close_if_unusable_or_obsolete(self):
+        # Called when requests start and finish
+        self.health_check_done = False
+        super(DatabaseWrapper, self).close_if_unusable_or_obsolete()
@@ -0,0 +1,89 @@
+from django.db.models import Q, Value
+from django.db.models.functions import Concat, Lower
+
+from rest_framework.filters import BaseFilterBackend
+
+# Sorts after every character that can appear in a column,
+# so prefix + PREFIX_UPPER_BOUND bounds every value starting with prefix
+PREFIX_UPPER_BOUND = '\U0010ffff'
+
+LOOKUP_SUFFIXES = {
+    'exact': '',
+    'startswith': '__startswith',
+    'iexact': '__iexact',
+    'istartswith': '__istartswith',
+}
+
+def lowered(field):
+    return '{}_lower'.format(field)
+
+def indexed_lookup(field, lookup, value):
+    '''
+    A Q object matching field against value that a B-tree
+    index can serve. Prefixes become ranges instead of LIKE,
+    which doesn't use indexes on case sensitive columns.
+    Case insensitive lookups compare LOWER(field), which has
+    to be annotated as lowered(field) and indexed.
+    '''
+    if lookup in ('iexact', 'istartswith'):
+        # Lowered by the database, as the index is
+        field, value = lowered(field), Lower(Value(value))
+    if lookup in ('exact', 'iexact'):
+        return Q(**{field: value})
+    upper = Concat(value, Value(PREFIX_UPPER_BOUND)) if isinstance(value, Lower) else value + PREFIX_UPPER_BOUND
+    return Q(**{field + '__gte': value, field + '__lt': upper})
+
+def annotate_lowered(queryset, fields):
+    return queryset.annotate(**{lowered(field): Lower(field) for field in fields})
+
+class IndexedFilterBackend(BaseFilterBackend):
+    '''
+    Filters on the view's indexed_filter_fields, mapping
+    each field to the lookups it allows, through
+    ?email=, ?username__startswith=, ?email__iexact=...
+    Every lookup needs an index, an expression index
+    on LOWER(field) for the case insensitive ones.
+    Only lists are filtered, get_object() ignores the filters.
+    '''
+    def filters_view(self, view):
+        return getattr(view, 'action', None) == 'list'
+
+    def filter_queryset(self, request, queryset, view):
+        if not self.filters_view(view):
+            return queryset
+        filters = []
+        for field, lookups in getattr(view, 'indexed_filter_fields', {}).items():
+            for lookup in lookups:
+                value = request.query_params.get(field + LOOKUP_SUFFIXES[lookup])
+                if value:
+                    filters.append((field, lookup, value))
+        return self.apply(queryset, filters, any_match=False)
+
+    def apply(self, queryset, filters, any_match):
+        if not filters:
+            return queryset
+        queryset = annotate_lowered(queryset, {
+            field for field, lookup, _ in filters if lookup.startswith('i')
+        })
+        combined = Q()
+        for field, lookup, value in filters:
+            condition = indexed_lookup(field, lookup, value)
+            combined = combined | condition if any_match else combined & condition
+        return queryset.filter(combined)
+
+class IndexedSearchFilter(IndexedFilterBackend):
+    '''
+    ?search=term matches any of the view's
+    indexed_search_fields, a field to lookup mapping
+    '''
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '').strip()
+        if not term or not self.filters_view(view):
+            return queryset
+        filters = [
+            (field, lookup, term)
+            for field, lookup in getattr(view, 'indexed_search_fields', {}).items()
+        ]
+        return self.apply(queryset, filters, any_match=True)
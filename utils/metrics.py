@@ -0,0 +1,105 @@
+'''
+In-process metrics, exposed in the Prometheus
+text format by utils.views.metrics.
+Every worker process keeps its own values.
+'''
+import threading
+
+_registry = []
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def items(self):
+        '''
+        Sorted copy of the values, taken under the lock
+        so a scrape never iterates over a changing dict
+        '''
+        with self._lock:
+            return sorted(self._values.items())
+
+    def samples(self):
+        for key, value in self.items():
+            yield self.name, key, value
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, buckets=None):
+        super(Histogram, self).__init__(name, help_text)
+        self.buckets = tuple(buckets or self.default_buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        '''
+        Number of observations
+        '''
+        counts, _ = self._values.get(self._key(labels), ([0], 0))
+        return counts[-1]
+
+    def items(self):
+        # observe() updates the counts in place
+        with self._lock:
+            return sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+
+    def samples(self):
+        for key, (counts, total) in self.items():
+            for bound, count in zip(self.buckets, counts):
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield self.name + '_bucket', key + (('le', le),), count
+            yield self.name + '_count', key, counts[-1]
+            yield self.name + '_sum', key, total
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in key) + '}'
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help_text))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for name, key, value in metric.samples():
+            lines.append('{}{} {}'.format(name, _format_labels(key), value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,102 @@
+import logging
+import random
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .profiling import Profile, describe_view, get_options as get_profiling_options, read_profile_token
+from .queries import QueryCounter, get_query_budget
+
+logger = logging.getLogger(__name__)
+
+class QueryBudgetMiddleware(object):
+    '''
+    Counts the queries and database time of every request and
+    reports them in a Server-Timing header.
+    Requests making more queries than their view declares in
+    query_budget_by_action, plus QUERY_BUDGET_SLACK (covering e.g.
+    a token cache miss), are logged as warnings.
+    Queries made while streaming a response aren't counted.
+    '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slack = getattr(settings, 'QUERY_BUDGET_SLACK', 0)
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+
+        response['Server-Timing'] = 'db;dur={:.2f};desc="{} queries", total;dur={:.2f}'.format(
+            counter.seconds * 1000, counter.count, total * 1000
+        )
+        budget = getattr(request, 'query_budget', None)
+        if budget is not None and counter.count > budget + self.slack:
+            logger.warning(
+                '%s %s made %d queries, over its budget of %d',
+                request.method, request.path, counter.count, budget,
+                extra={'request': request, 'queries': counter.count, 'budget': budget},
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = get_query_budget(view_func, request.method)
+
+class ProfilingMiddleware(object):
+    '''
+    Profiles requests with REQUEST_PROFILING['HEADER'] set to a
+    utils.profiling.profile_token(), in the format it names and
+    returning the file name in X-Profile-Id, and a SAMPLE_RATE
+    fraction of the others in FORMAT.
+    Profiles are tagged with the view and action, see utils.profiling.
+    One request is profiled at a time per process, and
+    streamed content isn't. Goes first, so the other
+    middleware are profiled too.
+    '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        profile_format = self.get_profile_format(request)
+        if profile_format is None or not self._lock.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            with Profile(profile_format) as profile:
+                response = self.get_response(request)
+            view = getattr(request, 'profiled_view', 'unresolved')
+            try:
+                name = profile.save(get_profiling_options()['DIRECTORY'], view)
+            except OSError:
+                # The request itself went fine
+                logger.exception('Could not save the profile of %s %s', request.method, request.path)
+                name = None
+        finally:
+            self._lock.release()
+        if request.profile_requested and name is not None:
+            response['X-Profile-Id'] = name
+        return response
+
+    def get_profile_format(self, request):
+        options = get_profiling_options()
+        header = options.get('HEADER', 'X-Profile')
+        token = request.META.get('HTTP_' + header.upper().replace('-', '_'))
+        request.profile_requested = False
+        if token is not None:
+            profile_format = read_profile_token(token)
+            if profile_format is not None:
+                request.profile_requested = True
+                return profile_format
+        if random.random() < options.get('SAMPLE_RATE', 0):
+            return options.get('FORMAT', 'prof')
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.profiled_view = describe_view(view_func, request.method)
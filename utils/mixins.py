@@ -1,3 +1,32 @@
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
+
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .models import VersionConflict
+from .serializers import ValuesSerializer
+from .streaming import stream_json_array
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The resource has been modified since it was fetched.'
+    default_code = 'precondition_failed'
+
+def etag_matches(header, etag, weak=False):
+    '''
+    Check if the If-Match (strong comparison) or
+    If-None-Match (weak comparison) header lists etag
+    '''
+    for candidate in parse_etags(header):
+        if weak and candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
 class MixedPermissionsMixin(object):
     permission_classes_by_action = {}
 
@@ -8,4 +37,195 @@ class MixedPermissionsMixin(object):
             '''
             If action is not specified, return default AllowAny permission
             '''
-            return [permission() for permission in self.permission_classes]
\ No newline at end of file
+            return [permission() for permission in self.permission_classes]
+
+class MixedThrottlesMixin(object):
+    '''
+    Throttles per action, actions missing from
+    throttle_classes_by_action use throttle_classes
+    '''
+    throttle_classes_by_action = {}
+
+    def get_throttles(self):
+        throttle_classes = self.throttle_classes_by_action.get(self.action, self.throttle_classes)
+        return [throttle() for throttle in throttle_classes]
+
+class StreamingListMixin(object):
+    '''
+    Lets list() stream every object as a chunked JSON
+    array, skipping pagination, when the request has
+    ?stream=1. Rows are read with iterator() so memory
+    stays flat regardless of the table size.
+    '''
+    stream_query_param = 'stream'
+    stream_chunk_size = 1000
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get(self.stream_query_param) in ('1', 'true'):
+            return self.stream_list(request)
+        return super(StreamingListMixin, self).list(request, *args, **kwargs)
+
+    def stream_list(self, request):
+        queryset = self.filter_queryset(self.get_queryset()).order_by('pk')
+        serializer = self.get_serializer()
+        compiled = ValuesSerializer.compile(serializer)
+        if compiled is not None:
+            items = (
+                compiled.to_representation(row)
+                for row in queryset.values(*compiled.columns).iterator(chunk_size=self.stream_chunk_size)
+            )
+        else:
+            items = (
+                serializer.to_representation(instance)
+                for instance in queryset.iterator(chunk_size=self.stream_chunk_size)
+            )
+        return StreamingHttpResponse(stream_json_array(items), content_type='application/json')
+
+class ValuesListMixin(object):
+    '''
+    Serves list() from values() rows through a ValuesSerializer,
+    skipping model instances and DRF's per-field machinery,
+    as long as the serializer only has plain column fields
+    '''
+    def list(self, request, *args, **kwargs):
+        compiled = ValuesSerializer.compile(self.get_serializer())
+        if compiled is None:
+            return super(ValuesListMixin, self).list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset()).values(*compiled.columns)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response([compiled.to_representation(row) for row in page])
+        return Response([compiled.to_representation(row) for row in queryset])
+
+class SparseFieldsetsMixin(object):
+    '''
+    Lets GET requests pick the fields they get back with
+    ?fields=id,username. Lists only read those columns
+    through ValuesListMixin, retrieves through only().
+    '''
+    fields_query_param = 'fields'
+
+    def get_requested_fields(self):
+        if self.request.method != 'GET':
+            return None
+        value = self.request.query_params.get(self.fields_query_param)
+        if not value:
+            return None
+        return [name.strip() for name in value.split(',') if name.strip()]
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super(SparseFieldsetsMixin, self).get_serializer(*args, **kwargs)
+        requested = self.get_requested_fields()
+        if requested is None:
+            return serializer
+        # The child of many=True serializers holds the fields
+        fields = getattr(serializer, 'child', serializer).fields
+        unknown = set(requested).difference(name for name, field in fields.items() if not field.write_only)
+        if unknown:
+            raise ValidationError({self.fields_query_param: ['Unknown fields: {}.'.format(', '.join(sorted(unknown)))]})
+        for name in list(fields):
+            if name not in requested:
+                fields.pop(name)
+        return serializer
+
+    def get_queryset(self):
+        queryset = super(SparseFieldsetsMixin, self).get_queryset()
+        if self.action != 'retrieve' or self.get_requested_fields() is None:
+            return queryset
+        compiled = ValuesSerializer.compile(self.get_serializer())
+        if compiled is None:
+            return queryset
+        # ConditionalMixin needs the etag_field
+        extra = [self.etag_field] if hasattr(self, 'etag_field') else []
+        return queryset.only(*(compiled.columns + extra))
+
+    def get_representation_key(self, instance):
+        key = super(SparseFieldsetsMixin, self).get_representation_key(instance)
+        requested = self.get_requested_fields()
+        if requested is None:
+            return key
+        return '{}:{}'.format(key, ','.join(sorted(requested)))
+
+    def get_etag(self, instance):
+        '''
+        Every fieldset is a representation of its own, with
+        its own ETag. Fields are joined with dots, as If-Match
+        and If-None-Match list ETags separated by commas.
+        '''
+        etag = super(SparseFieldsetsMixin, self).get_etag(instance)
+        requested = self.get_requested_fields()
+        if requested is None:
+            return etag
+        return '{}-{}"'.format(etag[:-1], '.'.join(sorted(requested)))
+
+class ConditionalMixin(object):
+    '''
+    Strong ETags for retrieve and update, built from the
+    object's etag_field, which must change on every save.
+    Retrieve answers a matching If-None-Match with a 304
+    before serializing, update answers a stale If-Match with a 412.
+    The model's save() has to raise VersionConflict when the row
+    changed since it was read (see utils.models.claim_version),
+    which is answered with a 412 too, so the If-Match check
+    and the write can't be interleaved with another write.
+    '''
+    etag_field = 'version'
+
+    def handle_exception(self, exc):
+        if isinstance(exc, VersionConflict):
+            exc = PreconditionFailed()
+        return super(ConditionalMixin, self).handle_exception(exc)
+
+    def get_etag(self, instance):
+        return '"{}-{}"'.format(instance.pk, getattr(instance, self.etag_field))
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        etag = self.get_etag(instance)
+        if etag_matches(request.META.get('HTTP_IF_NONE_MATCH', ''), etag, weak=True):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = self.get_representation_response(instance)
+        response['ETag'] = etag
+        return response
+
+    def get_representation_response(self, instance):
+        return Response(self.get_serializer(instance).data)
+
+    def update(self, request, *args, **kwargs):
+        partial = kwargs.pop('partial', False)
+        instance = self.get_object()
+        if_match = request.META.get('HTTP_IF_MATCH')
+        if if_match is not None and not etag_matches(if_match, self.get_etag(instance)):
+            raise PreconditionFailed()
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        response = Response(serializer.data)
+        response['ETag'] = self.get_etag(serializer.instance)
+        return response
+
+class CachedRepresentationMixin(object):
+    '''
+    Caches the rendered JSON of retrieved objects in
+    representation_cache (a ConfiguredCache). Keys start with the
+    object's pk and etag_field, so once the object is saved
+    every entry rendered from it, whatever its fieldset, is
+    left behind and ages out of the cache, with nothing to
+    delete. Goes before ConditionalMixin.
+    '''
+    representation_cache = None
+
+    def get_representation_response(self, instance):
+        if self.request.accepted_media_type != JSONRenderer.media_type:
+            # Other renderers, or JSON with parameters such as indent
+            return super(CachedRepresentationMixin, self).get_representation_response(instance)
+        key = self.get_representation_key(instance)
+        content = self.representation_cache.get(key)
+        if content is None:
+            content = JSONRenderer().render(self.get_serializer(instance).data)
+            self.representation_cache.set(key, content)
+        return HttpResponse(content, content_type=JSONRenderer.media_type)
+
+    def get_representation_key(self, instance):
+        return '{}:{}'.format(instance.pk, getattr(instance, self.etag_field))
@@ -0,0 +1,24 @@
+from django.db import DatabaseError
+from django.db.models import F
+
+class VersionConflict(DatabaseError):
+    '''
+    Raised when saving an instance whose row was
+    saved by someone else since it was read
+    '''
+
+def claim_version(instance, field='version', using=None):
+    '''
+    Bumps the instance's version column, in an UPDATE matching
+    only the version the instance was read at. The UPDATE locks
+    the row until the end of the transaction, so the rest of the
+    save can't be interleaved with another one.
+    Raises VersionConflict if the row was saved in the meantime.
+    '''
+    expected = getattr(instance, field)
+    updated = type(instance)._base_manager.using(using).filter(
+        pk=instance.pk, **{field: expected}
+    ).update(**{field: F(field) + 1})
+    if not updated:
+        raise VersionConflict('{} {} was modified since it was read.'.format(type(instance).__name__, instance.pk))
+    setattr(instance, field, expected + 1)
@@ -0,0 +1,157 @@
+'''
+On-demand request profiles, written by ProfilingMiddleware
+(utils.middleware) and summed up by manage.py profile_report.
+
+Each profile is a file in REQUEST_PROFILING['DIRECTORY'] named
+<time>_<pid>_<view>.<format>, the view being e.g.
+UserViewSet.change_password. Formats are:
+
+    prof       cProfile stats, for pstats or snakeviz
+    collapsed  sampled stacks, one "frame;frame;frame count" per
+               line, for flamegraph.pl or speedscope
+'''
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core import signing
+
+FORMATS = ('prof', 'collapsed')
+SALT = 'utils.profiling'
+
+def get_options():
+    return getattr(settings, 'REQUEST_PROFILING', {})
+
+def profile_token(profile_format='prof'):
+    '''
+    Value of the REQUEST_PROFILING['HEADER'] header profiling
+    a request, valid for HEADER_MAX_AGE seconds
+    '''
+    if profile_format not in FORMATS:
+        raise ValueError('Unknown profile format {}.'.format(profile_format))
+    return signing.TimestampSigner(salt=SALT).sign(profile_format)
+
+def read_profile_token(token):
+    '''
+    The format requested by a header value,
+    None if it isn't valid
+    '''
+    try:
+        profile_format = signing.TimestampSigner(salt=SALT).unsign(
+            token, max_age=get_options().get('HEADER_MAX_AGE', 60 * 60)
+        )
+    except signing.BadSignature:
+        return None
+    return profile_format if profile_format in FORMATS else None
+
+def describe_view(view_func, method):
+    '''
+    ViewSet.action for viewsets, View.method for other
+    class-based views, the function name otherwise
+    '''
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return getattr(view_func, '__name__', 'view')
+    actions = getattr(view_func, 'actions', None) or {}
+    return '{}.{}'.format(cls.__name__, actions.get(method.lower(), method.lower()))
+
+def frame_name(frame):
+    return '{}.{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+class StackSampler(object):
+    '''
+    Samples the stack of the thread it's created in every
+    interval seconds, from a background thread, counting
+    the collapsed stacks. Unlike cProfile, the profiled
+    code runs at full speed.
+    '''
+    def __init__(self, interval=.001):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as output:
+            for stack, count in self.stacks.most_common():
+                output.write('{} {}\n'.format(stack, count))
+
+class Profile(object):
+    '''
+    Profiles the code run in its block in one of FORMATS,
+    then writes it to directory with save()
+    '''
+    def __init__(self, profile_format):
+        self.format = profile_format
+
+    def __enter__(self):
+        if self.format == 'prof':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = StackSampler(get_options().get('SAMPLE_INTERVAL', .001)).__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.format == 'prof':
+            self.profiler.disable()
+        else:
+            self.profiler.__exit__(*exc_info)
+
+    def save(self, directory, view):
+        '''
+        Writes the profile, dropping the oldest ones beyond
+        REQUEST_PROFILING['MAX_FILES']. Returns the file name.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        name = '{:.6f}_{}_{}.{}'.format(time.time(), os.getpid(), view, self.format)
+        path = os.path.join(directory, name)
+        if self.format == 'prof':
+            self.profiler.dump_stats(path)
+        else:
+            self.profiler.dump(path)
+        rotate(directory, get_options().get('MAX_FILES', 500))
+        return name
+
+def parse_name(name):
+    '''
+    The (view, format) of a profile file name, None for other files
+    '''
+    stem, extension = os.path.splitext(name)
+    parts = stem.split('_', 2)
+    if extension[1:] not in FORMATS or len(parts) != 3:
+        return None
+    return parts[2], extension[1:]
+
+def rotate(directory, max_files):
+    # Names start with the time, so they sort oldest first
+    names = sorted(name for name in os.listdir(directory) if parse_name(name))
+    for name in names[:max(0, len(names) - max_files)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            # Rotated by another worker
+            pass
@@ -0,0 +1,34 @@
+import time
+
+TRANSACTION_CONTROL = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+class QueryCounter(object):
+    '''
+    Execute wrapper counting the queries it sees and their time.
+    Transaction control statements aren't counted, so counts
+    are the same inside a test's transaction and outside of it.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            if not sql.startswith(TRANSACTION_CONTROL):
+                self.count += 1
+
+def get_query_budget(view_func, method):
+    '''
+    The queries a viewset declares for the action
+    handling method, in its query_budget_by_action.
+    None for undeclared actions and other views.
+    '''
+    actions = getattr(view_func, 'actions', None)
+    if not actions:
+        return None
+    budgets = getattr(view_func.cls, 'query_budget_by_action', {})
+    return budgets.get(actions.get(method.lower()))
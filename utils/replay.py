@@ -0,0 +1,141 @@
+'''
+In-process replay of a JSONL request log, one request per line:
+
+    {"method": "POST", "path": "/get_auth_token/",
+     "headers": {"Authorization": "Token ..."}, "body": {...}}
+
+Only path is required. Requests go through the full
+middleware stack with Django's test client. manage.py replay
+runs them against a throwaway test database, recorded writes
+reach the configured one only with --live-database.
+'''
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.db import connection
+from django.test import Client
+from django.urls import Resolver404, resolve
+
+def load_log(path):
+    with open(path) as log:
+        return [json.loads(line) for line in log if line.strip()]
+
+def route_name(path):
+    try:
+        return resolve(urlsplit(path).path).view_name
+    except Resolver404:
+        return 'unresolved'
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return 0
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+class Replayer(object):
+    def __init__(self, entries, concurrency=1):
+        self.entries = entries
+        self.concurrency = concurrency
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = Client()
+        return self._local.client
+
+    def _send(self, entry):
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        extra = {
+            'HTTP_' + name.upper().replace('-', '_'): value
+            for name, value in entry.get('headers', {}).items()
+        }
+        body = entry.get('body')
+        data = json.dumps(body) if body is not None else ''
+        start = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self._client().generic(
+                entry.get('method', 'GET').upper(), entry['path'], data, 'application/json', **extra
+            )
+            if response.streaming:
+                for chunk in response.streaming_content:
+                    pass
+        elapsed = time.perf_counter() - start
+        return route_name(entry['path']), response.status_code, elapsed, len(queries)
+
+    def _send_closing(self, entry):
+        try:
+            return self._send(entry)
+        finally:
+            if self.concurrency > 1:
+                # Threads don't go through request_finished
+                connection.close()
+
+    def run(self):
+        '''
+        Returns a dict of overall and per route results,
+        latencies are in milliseconds
+        '''
+        start = time.perf_counter()
+        if self.concurrency > 1:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                samples = list(pool.map(self._send_closing, self.entries))
+        else:
+            samples = [self._send(entry) for entry in self.entries]
+        wall = time.perf_counter() - start
+
+        by_route = defaultdict(list)
+        for route, status_code, elapsed, queries in samples:
+            by_route[route].append((status_code, elapsed, queries))
+        routes = {}
+        for route, route_samples in sorted(by_route.items()):
+            latencies = sorted(elapsed * 1000 for _, elapsed, _ in route_samples)
+            statuses = defaultdict(int)
+            for status_code, _, _ in route_samples:
+                statuses[str(status_code)] += 1
+            routes[route] = {
+                'requests': len(route_samples),
+                'statuses': dict(statuses),
+                'p50_ms': percentile(latencies, .50),
+                'p95_ms': percentile(latencies, .95),
+                'p99_ms': percentile(latencies, .99),
+                'mean_ms': sum(latencies) / len(latencies),
+                'queries_per_request': sum(queries for _, _, queries in route_samples) / len(route_samples),
+            }
+        return {
+            'requests': len(samples),
+            'concurrency': self.concurrency,
+            'seconds': wall,
+            'requests_per_second': len(samples) / wall if wall else 0,
+            'routes': routes,
+        }
+
+def compare(results, baseline, max_regression):
+    '''
+    Regressions of results against baseline, as messages.
+    A route regresses when its p95 grows by more than
+    max_regression (a fraction) or it makes more queries.
+    '''
+    regressions = []
+    for route, current in sorted(results['routes'].items()):
+        previous = baseline.get('routes', {}).get(route)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + max_regression):
+            regressions.append('{}: p95 went from {:.2f}ms to {:.2f}ms'.format(
+                route, previous['p95_ms'], current['p95_ms']))
+        if current['queries_per_request'] > previous['queries_per_request']:
+            regressions.append('{}: queries per request went from {:.2f} to {:.2f}'.format(
+                route, previous['queries_per_request'], current['queries_per_request']))
+    return regressions
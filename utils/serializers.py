@@ -0,0 +1,47 @@
+from rest_framework import fields as serializer_fields
+
+# Fields whose to_representation returns column values unchanged
+PASSTHROUGH_FIELDS = (
+    serializer_fields.BooleanField,
+    serializer_fields.CharField,
+    serializer_fields.EmailField,
+    serializer_fields.IntegerField,
+)
+
+class ValuesSerializer(object):
+    '''
+    Read-only fast path of a ModelSerializer, mapping
+    values() rows straight to dicts. The fields' converters
+    are looked up once, fields passing columns through
+    unchanged don't get called at all.
+    Build it with compile(), which returns None for
+    serializers with fields that aren't plain columns.
+    '''
+    def __init__(self, fields, columns):
+        self.fields = fields
+        self.columns = columns
+
+    @classmethod
+    def compile(cls, serializer):
+        model = serializer.Meta.model
+        concrete = {field.name: field for field in model._meta.concrete_fields}
+        fields = []
+        for field in serializer.fields.values():
+            if field.write_only:
+                continue
+            model_field = concrete.get(field.source)
+            if model_field is None or model_field.is_relation:
+                return None
+            convert = None if type(field) in PASSTHROUGH_FIELDS else field.to_representation
+            fields.append((field.field_name, field.source, convert))
+        columns = [source for _, source, _ in fields]
+        if model._meta.pk.name not in columns:
+            # Needed by keyset pagination
+            columns.append(model._meta.pk.name)
+        return cls(fields, columns)
+
+    def to_representation(self, row):
+        return {
+            name: row[source] if convert is None or row[source] is None else convert(row[source])
+            for name, source, convert in self.fields
+        }
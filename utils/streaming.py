@@ -0,0 +1,60 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.utils.encoders import JSONEncoder
+
+def stream_json_array(items, batch_size=100):
+    '''
+    Encodes items as a JSON array, yielding one
+    chunk every batch_size items so only that
+    many are held in memory at once
+    '''
+    yield '['
+    separator = ''
+    batch = []
+    for item in items:
+        batch.append(json.dumps(item, cls=JSONEncoder))
+        if len(batch) == batch_size:
+            yield separator + ','.join(batch)
+            separator = ','
+            batch = []
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']'
+
+def keyset_batches(queryset, fields, batch_size=1000, after=None):
+    '''
+    Reads values_list rows ordered by pk, one
+    WHERE pk > last LIMIT batch_size query at a time,
+    so a single batch is all that's held in memory.
+    The pk has to be the first of fields.
+    '''
+    queryset = queryset.order_by('pk').values_list(*fields)
+    while True:
+        page = queryset if after is None else queryset.filter(pk__gt=after)
+        batch = list(page[:batch_size])
+        if not batch:
+            return
+        yield batch
+        after = batch[-1][0]
+
+def stream_ndjson(fields, batches):
+    '''
+    One JSON object per line, one chunk per batch of rows
+    '''
+    for batch in batches:
+        yield ''.join(json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + '\n' for row in batch)
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+def stream_csv(fields, batches):
+    '''
+    A header line followed by the rows, one chunk per batch
+    '''
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for batch in batches:
+        yield ''.join(writer.writerow(row) for row in batch)
@@ -0,0 +1,21 @@
+from contextlib import contextmanager
+
+from django.db import connection
+
+from .queries import QueryCounter
+
+class QueryBudgetTestMixin(object):
+    '''
+    TestCase mixin asserting views make exactly
+    the queries they declare in query_budget_by_action
+    '''
+    @contextmanager
+    def assertActionQueries(self, view_class, action):
+        expected = view_class.query_budget_by_action[action]
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            yield
+        self.assertEqual(
+            counter.count, expected,
+            '{} queries made by {}.{}, {} declared'.format(counter.count, view_class.__name__, action, expected)
+        )
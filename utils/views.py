@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+
+from rest_framework.authentication import get_authorization_header
+from rest_framework.permissions import BasePermission
+from rest_framework.views import APIView
+
+from . import metrics as registry
+
+class CanScrapeMetrics(BasePermission):
+    '''
+    Staff users, or scrapers sending METRICS_TOKEN
+    as "Authorization: Bearer <token>"
+    '''
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        token = getattr(settings, 'METRICS_TOKEN', None)
+        auth = get_authorization_header(request).split()
+        return bool(
+            token and len(auth) == 2 and auth[0].lower() == b'bearer' and
+            constant_time_compare(auth[1], token.encode('latin-1'))
+        )
+
+class MetricsView(APIView):
+    '''
+    Prometheus scrape endpoint
+    '''
+    permission_classes = (CanScrapeMetrics,)
+
+    def get(self, request):
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4')
+
+metrics = MetricsView.as_view()